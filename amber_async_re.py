@@ -1,11 +1,15 @@
 import os
 
+from numpy import asarray
+
 import amberio.ambertools as at
+from amberio.rst7 import read_rst7_coordinates
 from amberio.amberrun import read_amber_groupfile, amberrun_from_files
 from pj_async_re import async_re_job, _exit
 
 __all__ = ['pj_amber_job', 'amber_states_from_configobj',
-           'extract_amber_coordinates', 'SUPPORTED_AMBER_ENGINES',
+           'extract_amber_coordinates', 'extract_amber_trace',
+           'SUPPORTED_AMBER_ENGINES',
            'DISANG_NAME', 'DUMPAVE_EXT'
            ]
 
@@ -104,6 +108,31 @@ class pj_amber_job(async_re_job):
             inpcrd = new_state.filenames['inpcrd']
             self._linkReplicaFile('%s_0.rst7'%self.basename,inpcrd,repl) 
 
+    def _inpTemplateFiles(self):
+        """Return the AMBER files from which the states were defined."""
+        templates = []
+        if self.keywords.get('AMBER_GROUPFILE') is not None:
+            templates.append(self.keywords.get('AMBER_GROUPFILE'))
+        for state in self.states:
+            if state.filenames['mdin'] not in templates:
+                templates.append(state.filenames['mdin'])
+        return templates
+
+    def _inpFiles(self, repl):
+        """Return the files written or linked by _buildInpFile()."""
+        wdir = 'r%d'%int(repl)
+        sid = self.status[int(repl)]['stateid_current']
+        cyc = self.status[int(repl)]['cycle_current']
+        state = self.states[sid]
+        inpfiles = ['%s/mdin'%wdir, '%s/prmtop'%wdir]
+        if state.has_restraints:
+            inpfiles.append('%s/%s'%(wdir,DISANG_NAME))
+        if state.has_refc:
+            inpfiles.append('%s/refc'%wdir)
+        if cyc == 1:
+            inpfiles.append('%s/%s_0.rst7'%(wdir,self.basename))
+        return inpfiles
+
     def _launchReplica(self, repl, cyc):
         """Launch an AMBER sub-job using pilot-job. 
 
@@ -141,6 +170,11 @@ class pj_amber_job(async_re_job):
 
         compute_unit = self.pilotcompute.submit_compute_unit(cpt_unit_desc)
         return compute_unit
+
+    def _observableEnvironment(self):
+        """Add the AMBER environment, needed by amberio, to the default."""
+        return (['AMBERHOME=%s'%at.AMBERHOME, 'MKL_HOME=%s'%at.MKL_HOME] + 
+                async_re_job._observableEnvironment(self))
         
     def _hasCompleted(self, repl, cyc):
         """
@@ -150,23 +184,76 @@ class pj_amber_job(async_re_job):
         """
         # TODO: Parse the output file and look for more sure signs of 
         #       completion?
-        rst = 'r%d/%s_%d.rst7'%(repl,self.basename,cyc)
-        if os.path.exists(rst):
+        rst = '%s_%d.rst7'%(self.basename,cyc)
+        if self._replicaFiles(repl).exists(rst):
             return async_re_job._hasCompleted(self,repl,cyc)
         else:
             return False
 
+    def _completionMarker(self, repl, cyc):
+        """
+        The output file is closed when a cycle completes (the restart file 
+        is also written every ntwr steps during the cycle).
+        """
+        return '%s_%d.out'%(self.basename,cyc)
+
     def _extractLastCoordinates(self, repl):
         """
-        Return a 3N list of coordinates from the last restart (rst7) file 
+        Return a 3N array of coordinates from the last restart (rst7) file 
         of a given replica.
         """
         cycle = self.status[repl]['cycle_current']
-        return extract_amber_coordinates(repl,self.basename,cycle)
+        return extract_amber_coordinates(repl,cycle,self.basename).ravel()
 
-def extract_amber_coordinates(replica, cycle, basename):
+def extract_amber_coordinates(replica, cycle, basename, atoms=None):
+    """
+    Return the coordinates of the given atoms (0-based indices, all atoms by
+    default) from the restart file of a replica at a given cycle as an 
+    (atoms x 3) array. Only the lines of a formatted restart file holding the
+    requested atoms are read; other restart files are read with Rst7.
+    """
     restrt_name = 'r%d/%s_%d.rst7'%(replica,basename,cycle)
-    return at.Rst7.open(restrt_name).coordinates
+    try:
+        return read_rst7_coordinates(restrt_name,atoms)
+    except ValueError:
+        crds = asarray(at.Rst7.open(restrt_name).coordinates).reshape((-1,3))
+        if atoms is not None:
+            crds = crds[atoms]
+        return crds
+
+def _read_last_line(filename, blocksize=1024):
+    """Return the last non-empty line of a file, reading backwards from EOF."""
+    f = open(filename,'rb')
+    try:
+        f.seek(0,os.SEEK_END)
+        pos = f.tell()
+        data = ''
+        while pos > 0:
+            size = min(blocksize,pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+            lines = data.rstrip().rsplit('\n',1)
+            if len(lines) > 1:
+                return lines[1].strip()
+        return data.strip()
+    finally:
+        f.close()
+
+def extract_amber_trace(replica, cycle, basename, nvalues=None):
+    """
+    Return the restraint coordinates at the end of a cycle of a replica, 
+    from the last line of its DUMPAVE (TRACE) file. A ValueError is raised if
+    the line is missing or does not have nvalues values after the step.
+    """
+    trace_name = 'r%d/%s_%d.%s'%(replica,basename,cycle,DUMPAVE_EXT)
+    try:
+        tokens = _read_last_line(trace_name).split()
+    except IOError:
+        raise ValueError('Cannot read %s'%trace_name)
+    if len(tokens) < 2 or (nvalues is not None and len(tokens) != nvalues+1):
+        raise ValueError('Bad last line in %s'%trace_name)
+    return asarray([float(value) for value in tokens[1:]])
 
 def amber_states_from_configobj(keywords, verbose=False):
     """Return an AmberRunCollection from an ASyncRE command file."""
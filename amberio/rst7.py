@@ -0,0 +1,82 @@
+"""
+Fast reading of coordinates from formatted AMBER restart (rst7) files.
+
+A formatted restart file has a title line, a line with the number of atoms
+(and optionally the time) and then the coordinates in fixed-width fields,
+six values of 12 characters (F12.7) per line, followed by the velocities
+and box, if any. The position of the coordinates of any atom in the file is
+therefore known, so only the lines holding the requested atoms need to be
+read. The whole set of coordinates is parsed with numpy, as fixed-width
+fields, rather than value by value.
+
+Files that do not have this layout (e.g. NetCDF restarts) raise a
+ValueError, so that callers can fall back to a general purpose reader such
+as ambertools.Rst7.
+"""
+from numpy import asarray, frombuffer, unique
+
+__all__ = ['read_rst7_coordinates']
+
+FIELD_WIDTH = 12
+FIELDS_PER_LINE = 6
+
+def _read_header(rst7):
+    """
+    Return the number of atoms, the offset of the first coordinate line and
+    the length of the coordinate lines (including the line terminator).
+    """
+    title = rst7.readline()
+    if title.startswith('CDF'):
+        raise ValueError('%s is not a formatted restart file'%rst7.name)
+    try:
+        natoms = int(rst7.readline().split()[0])
+    except (IndexError,ValueError):
+        raise ValueError('Bad number of atoms in %s'%rst7.name)
+    start = rst7.tell()
+    first = rst7.readline()
+    values = first.rstrip('\r\n')
+    nvalues = min(FIELDS_PER_LINE,3*natoms)
+    if len(values) != nvalues*FIELD_WIDTH:
+        raise ValueError('%s does not have %d %d character fields per line'
+                         %(rst7.name,FIELDS_PER_LINE,FIELD_WIDTH))
+    return natoms,start,FIELDS_PER_LINE*FIELD_WIDTH + len(first) - len(values)
+
+def _parse_fields(text, nvalues):
+    """Parse nvalues fixed-width fields from a string without newlines."""
+    if len(text) < nvalues*FIELD_WIDTH:
+        raise ValueError('Truncated restart file')
+    fields = frombuffer(text[:nvalues*FIELD_WIDTH],
+                        dtype='S%d'%FIELD_WIDTH)
+    return fields.astype(float)
+
+def read_rst7_coordinates(filename, atoms=None):
+    """
+    Return the coordinates of the given atoms (0-based indices, all atoms
+    by default) in a formatted restart file as a (len(atoms), 3) array.
+    """
+    rst7 = open(filename,'rb')
+    try:
+        natoms,start,linelen = _read_header(rst7)
+        if atoms is None:
+            nlines = (3*natoms + FIELDS_PER_LINE - 1)/FIELDS_PER_LINE
+            rst7.seek(start)
+            text = ''.join(rst7.readline().rstrip('\r\n')
+                           for n in xrange(nlines))
+            return _parse_fields(text,3*natoms).reshape((natoms,3))
+
+        atoms = asarray(atoms,dtype=int)
+        if len(atoms) > 0 and (atoms.min() < 0 or atoms.max() >= natoms):
+            raise IndexError('Atom index out of range for %d atoms in %s'
+                             %(natoms,filename))
+        # Read each line holding a requested coordinate once.
+        values = (3*atoms[:,None] + [0,1,2]).ravel()
+        lines = {}
+        for line in unique(values/FIELDS_PER_LINE):
+            rst7.seek(start + line*linelen)
+            lines[line] = rst7.read(FIELDS_PER_LINE*FIELD_WIDTH)
+        crds = [lines[v/FIELDS_PER_LINE][(v%FIELDS_PER_LINE)*FIELD_WIDTH:
+                                         (v%FIELDS_PER_LINE+1)*FIELD_WIDTH]
+                for v in values]
+        return _parse_fields(''.join(crds),len(values)).reshape((-1,3))
+    finally:
+        rst7.close()
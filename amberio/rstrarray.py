@@ -0,0 +1,203 @@
+"""
+Vectorized evaluation of AMBER nmropt restraints.
+
+The routines in coordinates.py evaluate one restraint of one configuration
+at a time with python lists. Here all of the restraints of a set of states
+are evaluated for a batch of R configurations (e.g. replicas) at once from
+an (R, N, 3) coordinate array, with a few numpy calls per restraint type.
+
+Coordinates may be given as an (R, N, 3) array, as R rows of 3N flattened
+coordinates, as a single (N, 3) array (as returned by
+rst7.read_rst7_coordinates()) or as a single flattened 3N list. Atom
+indices are 0-based, as in coordinates.py. The coordinates of only the
+restrained atoms (RestraintArray.atoms) can also be given, as returned by
+rst7.read_rst7_coordinates().
+
+Example:
+>>> rstrs = RestraintArray([state.rstr for state in states])
+>>> x = rstrs.coordinates(crds)  # (R, M) restraint coordinates
+>>> u = rstrs.energies(x)        # (states, R) restraint energies (kcal/mol)
+"""
+from numpy import asarray, zeros, sqrt, arccos, cross, pi, where, isinf, \
+    rint, newaxis, unique, concatenate
+
+from rstr import AmberRestraint, BondRestraint, AngleRestraint, \
+    TorsionRestraint, GenDistCoordRestraint
+
+__all__ = ['as_coordinate_batch', 'bonds', 'angles', 'dihedrals',
+           'gendist_coordinates', 'wrap_periodic', 'flat_bottom_energy',
+           'RestraintArray']
+
+def as_coordinate_batch(crds):
+    """Return coordinates as an (R, N, 3) array (see the module docstring)."""
+    crds = asarray(crds,dtype=float)
+    if crds.ndim == 3:
+        return crds
+    elif crds.ndim == 2 and crds.shape[1] == 3:
+        return crds[newaxis]
+    return crds.reshape((1 if crds.ndim == 1 else len(crds),-1,3))
+
+def _dot(u, v):
+    return (u*v).sum(axis=-1)
+
+def bonds(crds, i, j):
+    """Return the (R, M) distances between atoms i[m] and j[m]."""
+    crds = as_coordinate_batch(crds)
+    v = crds[:,i] - crds[:,j]
+    return sqrt(_dot(v,v))
+
+def angles(crds, i, j, k):
+    """Return the (R, M) angles (in radians) between atoms i[m], j[m], k[m]."""
+    crds = as_coordinate_batch(crds)
+    vBA = crds[:,j] - crds[:,i]
+    vBC = crds[:,j] - crds[:,k]
+    cos_angle = _dot(vBA,vBC)/sqrt(_dot(vBA,vBA)*_dot(vBC,vBC))
+    return arccos(cos_angle.clip(-1.,1.))
+
+def dihedrals(crds, i, j, k, l):
+    """
+    Return the (R, M) dihedrals (in radians, between 0 and 2 pi) defined by
+    atoms i[m], j[m], k[m] and l[m], with the same convention as
+    DihedralFromVecs() in coordinates.py.
+    """
+    crds = as_coordinate_batch(crds)
+    vAB = crds[:,i] - crds[:,j]
+    vBC = crds[:,j] - crds[:,k]
+    vCD = crds[:,k] - crds[:,l]
+    nABC = cross(vAB,vBC)
+    nBCD = cross(vBC,vCD)
+    denom = sqrt(_dot(nABC,nABC)*_dot(nBCD,nBCD))
+    defined = denom > 1.e-30
+    cos_dihedral = -_dot(nABC,nBCD)/where(defined,denom,1.)
+    dihedral = arccos(cos_dihedral.clip(-1.,1.))
+    dihedral = where(_dot(vBC,cross(nABC,nBCD)) > 0.,-dihedral,dihedral)
+    return where(defined,pi - dihedral,0.)
+
+def gendist_coordinates(crds, i, j, weights, groups, ngroups):
+    """
+    Return the (R, ngroups) generalized distance coordinates, each the sum
+    of the weighted distances between atoms i[p] and j[p] of the pairs p
+    with groups[p] equal to its index.
+    """
+    d = bonds(crds,i,j)*asarray(weights)
+    x = zeros((len(d),ngroups))
+    for g in xrange(ngroups):
+        x[:,g] = d[:,asarray(groups) == g].sum(axis=1)
+    return x
+
+def wrap_periodic(dx, period):
+    """
+    Return the differences dx wrapped into [-period/2, period/2] (period
+    may be an array broadcast against dx, infinite for no periodicity).
+    """
+    period = asarray(period,dtype=float)
+    finite = ~isinf(period)
+    images = rint(dx/where(finite,period,1.))*where(finite,period,0.)
+    return dx - images
+
+def flat_bottom_energy(x, r1, r2, r3, r4, rk2, rk3, kfac=1., period=None):
+    """
+    Return the energies of AMBER flat-bottomed restraints with coordinate
+    values x, all arguments being broadcast against each other. The energy
+    is zero between r2 and r3, harmonic with force constant rk2 between r1
+    and r2 (rk3 between r3 and r4) and linear beyond r1 (r4). Force
+    constants are in kcal/mol per unit of x squared once multiplied by kfac
+    (e.g. (pi/180)^2 for angles in degrees). Periodic coordinates are first
+    translated within half a period of the center of the flat bottom.
+    """
+    x = asarray(x,dtype=float)
+    if period is not None:
+        center = 0.5*(asarray(r2) + asarray(r3))
+        x = center + wrap_periodic(x - center,period)
+    rk2 = kfac*asarray(rk2)
+    rk3 = kfac*asarray(rk3)
+    d12 = asarray(r1) - r2
+    d43 = asarray(r4) - r3
+    return where(x < r1, rk2*d12*(d12 + 2.*(x - r1)),
+           where(x < r2, rk2*(x - r2)**2,
+           where(x <= r3, 0.,
+           where(x <= r4, rk3*(x - r3)**2,
+                 rk3*d43*(d43 + 2.*(x - r4))))))
+
+
+class RestraintArray(object):
+    """
+    The restraints of one or more states (AmberRestraint objects with the
+    same restraint coordinates, but possibly different parameters) as
+    arrays. The parameters r1, r2, r3, r4, rk2 and rk3 are (states, M)
+    arrays for the M restraints, kfac and image_dist (M,) arrays.
+    """
+    def __init__(self, restraint_sets):
+        if isinstance(restraint_sets,AmberRestraint):
+            restraint_sets = [restraint_sets]
+        rstrs = restraint_sets[0]
+        self.nrestraints = len(rstrs)
+        for name in ['r1','r2','r3','r4','rk2','rk3']:
+            setattr(self,name,asarray([getattr(r,name) for r in
+                                       restraint_sets],dtype=float))
+        self.kfac = asarray(rstrs.kfac,dtype=float)
+        self.image_dist = asarray(rstrs.image_dist,dtype=float)
+        # Atom indices (0-based) and restraint indices of each type.
+        self._types = {}
+        for cls,natoms in [(BondRestraint,2),(AngleRestraint,3),
+                           (TorsionRestraint,4)]:
+            index = [m for m,r in enumerate(rstrs) if type(r) is cls]
+            iat = asarray([rstrs[m]['iat'][:natoms] for m in index],
+                          dtype=int).reshape((len(index),natoms)) - 1
+            self._types[cls] = (asarray(index,dtype=int),iat.T)
+        index = [m for m,r in enumerate(rstrs)
+                 if isinstance(r,GenDistCoordRestraint)]
+        pairs = [(rstrs[m]['iat'][0::2],rstrs[m]['iat'][1::2],
+                  rstrs[m]['rstwt']) for m in index]
+        self._gendist = (asarray(index,dtype=int),
+                         asarray([i-1 for p in pairs for i in p[0]],dtype=int),
+                         asarray([j-1 for p in pairs for j in p[1]],dtype=int),
+                         asarray([w for p in pairs for w in p[2]],dtype=float),
+                         asarray([g for g,p in enumerate(pairs)
+                                  for w in p[2]],dtype=int))
+        # The sorted indices of the atoms of all restraints.
+        iats = [iat.ravel() for index,iat in self._types.values()]
+        self.atoms = unique(concatenate(iats + list(self._gendist[1:3])))
+
+    def coordinates(self, crds, compact=False):
+        """
+        Return the (R, M) restraint coordinates of a batch of configurations
+        (angles and torsions in degrees, as in AmberRestraint.coordinates()).
+        If compact is True, crds only holds the coordinates of the atoms in
+        self.atoms, in that order (see rst7.read_rst7_coordinates()).
+        """
+        crds = as_coordinate_batch(crds)
+        if compact:
+            atom_index = self.atoms.searchsorted
+        else:
+            atom_index = lambda iat: iat
+        x = zeros((len(crds),self.nrestraints))
+        index,iat = self._types[BondRestraint]
+        if len(index) > 0:
+            x[:,index] = bonds(crds,*atom_index(iat))
+        index,iat = self._types[AngleRestraint]
+        if len(index) > 0:
+            x[:,index] = angles(crds,*atom_index(iat))*(180/pi)
+        index,iat = self._types[TorsionRestraint]
+        if len(index) > 0:
+            x[:,index] = dihedrals(crds,*atom_index(iat))*(180/pi)
+        index,i,j,weights,groups = self._gendist
+        if len(index) > 0:
+            x[:,index] = gendist_coordinates(crds,atom_index(i),atom_index(j),
+                                             weights,groups,len(index))
+        return x
+
+    def energies(self, x, states=None):
+        """
+        Return the total restraint energies (kcal/mol) of a batch of
+        restraint coordinates x (R, M) in each of the given states (indices
+        of the restraint sets, all by default) as a (states, R) array.
+        """
+        if states is None:
+            states = slice(None)
+        x = asarray(x,dtype=float)[newaxis]
+        params = [getattr(self,name)[states][:,newaxis]
+                  for name in ['r1','r2','r3','r4','rk2','rk3']]
+        u = flat_bottom_energy(x,*params,kfac=self.kfac,
+                               period=self.image_dist)
+        return u.sum(axis=-1)
@@ -1,12 +1,14 @@
 import os
-from multiprocessing import Pool, cpu_count
+from functools import partial
 
-from configobj import ConfigObj
-from numpy import zeros, asarray, abs, any
+from numpy import zeros, ones, asarray, any, isinf, allclose
 
 import amberio.ambertools as at
-from amber_async_re import pj_amber_job, amber_states_from_configobj, \
-    extract_amber_coordinates, DISANG_NAME, DUMPAVE_EXT, _exit
+from amberio.rstrarray import RestraintArray
+from state_graph import grid_shape, grid_spacing
+from amber_async_re import pj_amber_job, extract_amber_coordinates, \
+    extract_amber_trace, DISANG_NAME, DUMPAVE_EXT, _exit
+from amberio.rstr import GenDistCoordRestraint
 
 def _parse_state_params(paramline, state_delimiter=':'):
     """
@@ -56,6 +58,15 @@ def _parse_bias_file(bias_filename):
             force_constants.append([float(k0) for k0 in tokens[1::2]])
     return bias_positions,force_constants
 
+def _restraint_template_name(keywords):
+    """
+    Return the name of the AMBER restraint template given in a ConfigObj (or
+    the default based on the basename).
+    """
+    if keywords.get('AMBER_RESTRAINT_TEMPLATE') is not None:
+        return keywords.get('AMBER_RESTRAINT_TEMPLATE')
+    return '%s.RST'%keywords.get('ENGINE_INPUT_BASENAME')
+
 def setup_us_states_from_configobj(states, keywords, verbose=False):
     """
     Augment a set of AMBER states to include umbrella sampling state
@@ -86,11 +97,7 @@ def setup_us_states_from_configobj(states, keywords, verbose=False):
               %(nreplicas,len(force_constants),len(bias_positions)))    
 
     # Look for a restraint template (try the basename?)
-    basename = keywords.get('ENGINE_INPUT_BASENAME')
-    if keywords.get('AMBER_RESTRAINT_TEMPLATE') is not None:
-        restraint_template = keywords.get('AMBER_RESTRAINT_TEMPLATE')
-    else:
-        restraint_template = '%s.RST'%basename
+    restraint_template = _restraint_template_name(keywords)
     if verbose:
         print 'Using restraint template file: %s'%restraint_template
 
@@ -101,6 +108,52 @@ def setup_us_states_from_configobj(states, keywords, verbose=False):
         state.rstr.r0 = r0
         state.rstr.k0 = k0
 
+def us_swap_params(states, beta, basename, use_trace=False):
+    """
+    Return the parameters needed to compute the reduced bias energies of
+    replicas in a set of umbrella sampling states: the inverse temperature, 
+    the basename of the coordinate files, the restraints of all states as a
+    RestraintArray and whether the restraint coordinates are read from the 
+    DUMPAVE (TRACE) files.
+    """
+    return {'beta': beta, 'basename': basename, 'use_trace': use_trace,
+            'rstr': RestraintArray([s.rstr for s in states])}
+
+def trace_coordinates_usable(states):
+    """
+    Return True if the last line of the DUMPAVE (TRACE) file of a cycle gives
+    the restraint coordinates of the final configuration in any of the 
+    states, or else a message explaining why not. The values must be dumped 
+    at the last step and generalized distance restraints, whose trace does not
+    carry their weights, are not supported.
+    """
+    for state in states:
+        if any([isinstance(r,GenDistCoordRestraint) for r in state.rstr]):
+            return 'generalized distance restraints are used'
+        nstlim = int(state.mdin.cntrl['nstlim'])
+        dumpfreq = [int(wt['istep1']) for wt in 
+                    state.mdin.wts.type_matches("'DUMPFREQ'")]
+        if len(dumpfreq) == 0 or dumpfreq[0] < 1 or nstlim%dumpfreq[0] != 0:
+            return 'the DUMPFREQ istep1 does not divide nstlim'
+    return True
+
+def us_restraint_coordinates(params, replica, cycle):
+    """
+    Return the restraint coordinates of a replica at the end of a cycle, from
+    the last line of its DUMPAVE (TRACE) file if params['use_trace'] is set 
+    and the line is complete, else from the restrained atoms of its restart 
+    file (see us_swap_params()).
+    """
+    rstrs = params['rstr']
+    if params['use_trace']:
+        try:
+            return extract_amber_trace(replica,cycle,params['basename'],
+                                       rstrs.nrestraints)
+        except ValueError:
+            pass
+    crds = extract_amber_coordinates(replica,cycle,params['basename'],
+                                     rstrs.atoms)
+    return rstrs.coordinates(crds,compact=True)[0]
 
 class amberus_async_re_job(pj_amber_job):
 
@@ -118,10 +171,62 @@ class amberus_async_re_job(pj_amber_job):
         # Umbrella sampling state information.
         #
         setup_us_states_from_configobj(self.states,self.keywords,self.verbose)
+        use_trace = False
+        if self.keywords.get('AMBER_TRACE_COORDINATES') is not None:
+            use_trace = (self.keywords.get('AMBER_TRACE_COORDINATES').lower()
+                         in ['yes','true','1'])
+        if use_trace:
+            usable = trace_coordinates_usable(self.states)
+            if usable is not True:
+                print ('Reading restraint coordinates from restart files, as '
+                       '%s'%usable)
+                use_trace = False
+        self.swap_params = us_swap_params(self.states,self.beta,self.basename,
+                                          use_trace)
+
+    def _observableExtractor(self):
+        """
+        The observables of a replica are its restraint coordinates. The 
+        restraint parameters of all states reach the processes of the 
+        observable pool once, when they start.
+        """
+        return partial(us_restraint_coordinates,self.swap_params)
  
-    def _computeSwapMatrix(self, replicas, states):
+    def _inpTemplateFiles(self):
+        """Return the AMBER and umbrella sampling template files."""
+        templates = pj_amber_job._inpTemplateFiles(self)
+        templates.append(_restraint_template_name(self.keywords))
+        if self.keywords.get('BIAS_FILE') is not None:
+            templates.append(self.keywords.get('BIAS_FILE'))
+        return templates
+
+    def _stateGridShape(self):
+        """Return the shape of the grid of bias positions (if they form one)."""
+        shape = grid_shape([state.rstr.r2 for state in self.states])
+        if shape is None:
+            print ('Bias positions do not form a regular grid, treating the '
+                   'states as a one dimensional ladder')
+            return (self.nreplicas,)
+        return shape
+
+    def _stateGridPeriodic(self):
+        """
+        Return True for the dimensions of the bias grid that span a full 
+        period (e.g. torsions spaced by 15 degrees over 360 degrees).
+        """
+        bias_positions = [state.rstr.r2 for state in self.states]
+        shape = grid_shape(bias_positions)
+        if shape is None:
+            return [False]
+        dimg = self.states[0].rstr.image_dist
+        return [(not isinf(L) and h is not None and allclose(n*h,L))
+                for n,h,L in zip(shape,grid_spacing(bias_positions,shape),
+                                 dimg)]
+
+    def _computeSwapBlock(self, replicas, states, mask=None):
         """
-        Compute the swap matrix U = (u_ij), where u_ij = u_i(x_j)
+        Compute the swap matrix U = (u_ij), where u_ij = u_i(x_j), for the 
+        given states i (rows) and replicas j (columns)
         
         Here it is assumed that u_i(x) = beta[U_0(x) + U_i(x)], so that 
         differences of the matrix elements only involve the bias potentials U_i:
@@ -130,85 +235,34 @@ class amberus_async_re_job(pj_amber_job):
                      = beta[U_0(x_i) + U_i(x_i)] + beta[U_0(x_j) + U_j(x_j)]
                        - beta[U_0(x_j) + U_i(x_j)] - beta[U_0(x_i) + U_j(x_i)]
                      =  beta[U_i(x_i) + U_i(x_j) - U_i(x_j) - U_j(x_i)]
+
+        Columns that the mask (if any) excludes entirely are not computed, 
+        which saves reading the coordinates of those replicas.
         """ 
-        cycles = [self.status[repl]['cycle_current'] for repl in replicas]      
-        nprocs = cpu_count()
-        while float(len(replicas))/nprocs <= 2: # This is arbitrary.
-            if nprocs/2 > 1:
-                nprocs /= 2
-            else:
-                nprocs = 1
-                break
-        print 'Computing swap matrix on %d processor(s)...'%nprocs
-        if nprocs == 1:
-            U = _compute_columns(zip(replicas,cycles),states,self.command_file)
+        if mask is None:
+            columns = ones(len(replicas),dtype=bool)
         else:
-            # Divide the replicas evenly amongst the processes. Add extra 
-            # replicas to the first few processes as needed to reach 
-            # len(replicas). 
-            avg_replicas_per_proc = int(len(replicas)/nprocs)
-            replicas_per_proc = [avg_replicas_per_proc for n in range(nprocs)]
-            for n in range(len(replicas)%nprocs):
-                replicas_per_proc[n] += 1
-
-            repl_cyc_pairs = []
-            for n in range(nprocs):
-                first = sum(replicas_per_proc[0:n])
-                last = first + replicas_per_proc[n]
-                repl_cyc_pairs.append(zip(replicas[first:last],
-                                          cycles[first:last]))
-
-            pool = Pool(processes=nprocs)
-            results = [pool.apply_async(_compute_columns,
-                                        args=(repl_cyc_pairs[n],states,
-                                              self.command_file))
-                       for n in range(nprocs)]
-            U = zeros([self.nreplicas,self.nreplicas])
-            for result in results:
-                U += asarray(result.get())
-            pool.close()
-            pool.join()
-        return U.tolist()
+            columns = mask.any(axis=0)
+        U = zeros((len(states),len(replicas)))
+        if any(columns):
+            # restraint coordinates, extracted in parallel by the core
+            x = self._observables([repl for repl,c in zip(replicas,columns) 
+                                   if c])
+            U[:,columns] = self.beta*self.swap_params['rstr'].energies(
+                asarray(x),states)
+        return U
 
     def _hasCompleted(self, repl, cyc):
         """Returns True if an umbrella sampling replica has completed a cycle.
         
         Basically checks if the trace file exists.
         """
-        trace = 'r%d/%s_%d.%s'%(repl,self.basename,cyc,DUMPAVE_EXT)
-        if os.path.exists(trace):
+        trace = '%s_%d.%s'%(self.basename,cyc,DUMPAVE_EXT)
+        if self._replicaFiles(repl).exists(trace):
             return pj_amber_job._hasCompleted(self,repl,cyc)
         else:
             return False
 
-def _compute_columns(replicas_and_cycles, states, command_file):
-    keywords = ConfigObj(command_file)
-    state_objs = amber_states_from_configobj(keywords)  
-    setup_us_states_from_configobj(state_objs,keywords)
-    nreplicas = len(state_objs) 
-    temp0 = state_objs.state_params_are_same('cntrl','temp0')
-    beta = 1./(at.KB*temp0)
-    basename = keywords.get('ENGINE_INPUT_BASENAME')
-
-    k0s = asarray([s.rstr.rk2 for s in state_objs])[states]
-    kfacs = asarray([s.rstr.kfac for s in state_objs])[states]
-    k0s *= kfacs
-    x0s = asarray([s.rstr.r2 for s in state_objs])[states]
-    dimg = asarray(state_objs[0].rstr.image_dist)
-
-    U = zeros([nreplicas,nreplicas])
-    for repl_i,cyc_n in replicas_and_cycles:
-        crds_i = extract_amber_coordinates(repl_i,cyc_n,basename)
-        x_i = asarray(state_objs[0].rstr.coordinates(crds_i))
-        dx = x_i - x0s
-        i = abs(dx) > 0.5*dimg
-        while any(i):
-            for dxi,mask in zip(dx,i):
-                dxi[mask] -= dimg[mask]
-            i = abs(dx) > 0.5*dimg
-        U[states,repl_i] += beta*(k0s*dx**2).sum(axis=1)
-    return U
-
 if __name__ == '__main__':
     import sys
     import time
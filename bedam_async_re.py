@@ -1,6 +1,16 @@
 import sys, time, random, math
+from functools import partial
+from numpy import outer
 from pj_async_re import async_re_job
-from impact_async_re import pj_impact_job
+from impact_async_re import pj_impact_job, impact_last_record
+
+def bedam_binding_energy(basename, replica, cycle):
+    """
+Returns the binding energy (last item of the last record of the Impact 
+output) of a replica at the end of a cycle.
+"""
+    record = impact_last_record(basename,replica,cycle)
+    return float(record[len(record)-1])
 
 
 class bedam_async_re_job(pj_impact_job):
@@ -49,27 +59,34 @@ specified cycle.
         stateid = self.status[replica]['stateid_current']
         cycle = self.status[replica]['cycle_current']
 
-        template = "%s.inp" % basename
         inpfile = "r%d/%s_%d.inp" % (replica, basename, cycle)
         lambd = self.lambdas[stateid]
-        # read template buffer
-        tfile = self._openfile(template, "r")
-        tbuffer = tfile.read()
-        tfile.close()
-        # make modifications
-        tbuffer = tbuffer.replace("@n@",str(cycle))
-        tbuffer = tbuffer.replace("@nm1@",str(cycle-1))
-        tbuffer = tbuffer.replace("@lambda@",lambd)
+        # fill in the template, read once and compiled for each state
+        tbuffer = self._inpTemplate().render(stateid, {"lambda": lambd},
+                                             {"n": str(cycle),
+                                              "nm1": str(cycle-1)})
         # write out
         ofile = self._openfile(inpfile, "w")
         ofile.write(tbuffer)
         ofile.close()
 
-        # update the history status file
-        ofile = self._openfile("r%d/state.history" % replica, "a")
-        ofile.write("%d %d %s\n" % (cycle, stateid, lambd))
-        ofile.close()
-        
+    def _stateLabel(self, stateid):
+        # written after the state id in r<k>/state.history
+        return self.lambdas[stateid]
+
+    def _inpTemplateFiles(self):
+        """
+Returns the template input file BASENAME.inp read by _buildInpFile()
+"""
+        return ["%s.inp" % self.basename]
+
+    def _inpFiles(self, replica):
+        """
+Returns the input file written by _buildInpFile() for a replica at its
+current cycle
+"""
+        cycle = self.status[replica]['cycle_current']
+        return ["r%d/%s_%d.inp" % (replica, self.basename, cycle)]
 
     def _doExchange_pair(self,repl_a,repl_b):
         """
@@ -113,14 +130,15 @@ Performs exchange of lambdas for BEDAM replica exchange.
 Extracts binding energy from Impact output
 """
         output_file = "r%s/%s_%d.out" % (repl,self.basename,cycle)
-        datai = self._getImpactData(output_file)
-        nf = len(datai[0])
-        nr = len(datai)
-        return datai[nr-1][nf-1]
+        record = self._getImpactLastData(output_file)
+        return record[len(record)-1]
 
     def _getPot(self,repl,cycle):
         return float(self._extractLast_BindingEnergy(repl,cycle))
 
+    def _observableExtractor(self):
+        return partial(bedam_binding_energy,self.basename)
+
     def _getPar(self,repl):
         sid = self.status[repl]['stateid_current']
         lmb = self.lambdas[sid]
@@ -132,6 +150,10 @@ Extracts binding energy from Impact output
         # This is for binding potential beta*lambda*u
         return self.bedam_beta*par*pot
 
+    def _reduced_energies(self,par,pot):
+        # beta*lambda*u of each replica (columns) in each state (rows)
+        return self.bedam_beta*outer(par,pot)
+
 
 if __name__ == '__main__':
 
@@ -1,6 +1,19 @@
 import sys, time, random, math
+from functools import partial
+from numpy import asarray
 from pj_async_re import async_re_job
 from bedam_async_re import bedam_async_re_job
+from impact_async_re import impact_last_record
+
+def bedamtempt_potentials(basename, replica, cycle):
+    """
+Returns (e0, u), the potential energy without the binding energy and the 
+binding energy of a replica at the end of a cycle (see _getPot()).
+"""
+    record = impact_last_record(basename,replica,cycle)
+    nf = len(record)
+    (lmb, u, etot) = (record[nf-2],record[nf-1],record[2])
+    return (float(etot) - float(lmb)*float(u),float(u))
 
 class bedamtempt_async_re_job(bedam_async_re_job):
 
@@ -27,6 +40,7 @@ class bedamtempt_async_re_job(bedam_async_re_job):
         temperatures = self.keywords.get('TEMPERATURES').split(',')
         #build parameters for the lambda/temperatures combined states
         self.nreplicas = self._buildBEDAMStates(lambdas,temperatures)
+        self.state_grid_shape = (len(lambdas),len(temperatures))
 
     def _buildBEDAMStates(self,lambdas,temperatures):
         self.stateparams = []
@@ -39,6 +53,12 @@ class bedamtempt_async_re_job(bedam_async_re_job):
         return len(self.stateparams)
 
 
+    def _stateGridShape(self):
+        """
+States form a lambdas x temperatures grid, temperature varying fastest.
+"""
+        return self.state_grid_shape
+
     def _buildInpFile(self, replica):
         """
 Builds input file for a BEDAM replica based on template input file
@@ -49,29 +69,25 @@ specified cycle.
         stateid = self.status[replica]['stateid_current']
         cycle = self.status[replica]['cycle_current']
 
-        template = "%s.inp" % basename
         inpfile = "r%d/%s_%d.inp" % (replica, basename, cycle)
         
         lambd = self.stateparams[stateid]['lambda']
         temperature = self.stateparams[stateid]['temperature']
-        # read template buffer
-        tfile = self._openfile(template, "r")
-        tbuffer = tfile.read()
-        tfile.close()
-        # make modifications
-        tbuffer = tbuffer.replace("@n@",str(cycle))
-        tbuffer = tbuffer.replace("@nm1@",str(cycle-1))
-        tbuffer = tbuffer.replace("@lambda@",lambd)
-        tbuffer = tbuffer.replace("@temperature@",temperature)
+        # fill in the template, read once and compiled for each state
+        tbuffer = self._inpTemplate().render(stateid,
+                                             {"lambda": lambd,
+                                              "temperature": temperature},
+                                             {"n": str(cycle),
+                                              "nm1": str(cycle-1)})
         # write out
         ofile = self._openfile(inpfile, "w")
         ofile.write(tbuffer)
         ofile.close()
 
-        # update the history status file
-        ofile = self._openfile("r%d/state.history" % replica, "a")
-        ofile.write("%d %d %s %s\n" % (cycle, stateid, lambd, temperature))
-        ofile.close()
+    def _stateLabel(self, stateid):
+        # written after the state id in r<k>/state.history
+        return "%s %s" % (self.stateparams[stateid]['lambda'],
+                          self.stateparams[stateid]['temperature'])
 
     def _doExchange_pair(self,repl_a,repl_b):
         """
@@ -135,16 +151,14 @@ Performs exchange of lambdas for BEDAM replica exchange.
 Extracts binding energy from Impact output
 """
         output_file = "r%s/%s_%d.out" % (repl,self.basename,cycle)
-        datai = self._getImpactData(output_file)
-        nf = len(datai[0])
-        nr = len(datai)
-        # [nr-1]: last record
+        record = self._getImpactLastData(output_file)
+        nf = len(record)
         # [nf-2]: lambda (next to last item)
         # [nf-1]: binding energy (last item)
         #    [2]: total energy item (0 is step number and 1 is temperature)
         #
         # (lambda, binding energy, total energy)
-        return (datai[nr-1][nf-2],datai[nr-1][nf-1],datai[nr-1][2])
+        return (record[nf-2],record[nf-1],record[2])
 
     def print_status(self):
         """
@@ -173,6 +187,9 @@ watch cat BASENAME_stat.txt
         e0 = float(etot) - float(lmb)*float(u)
         return (e0,float(u))
 
+    def _observableExtractor(self):
+        return partial(bedamtempt_potentials,self.basename)
+
     def _getPar(self,repl):
         sid = self.status[repl]['stateid_current']
         lmb = float(self.stateparams[sid]['lambda'])
@@ -191,6 +208,14 @@ watch cat BASENAME_stat.txt
         u = pot[1]
         return beta*(e0 + lmb*u)
 
+    def _reduced_energies(self,par,pot):
+        # beta*(e0 + lambda*u) of each replica (columns) in each state (rows)
+        par = asarray(par,dtype=float)
+        pot = asarray(pot,dtype=float)
+        beta = par[:,0:1]
+        lmb = par[:,1:2]
+        return beta*(pot[:,0] + lmb*pot[:,1])
+
 if __name__ == '__main__':
 
     # Parse arguments:
@@ -0,0 +1,172 @@
+"""
+Event driven detection of replica completion on Linux.
+
+An inotify_watcher follows a set of "completion markers", files that an MD
+engine writes when it finishes a cycle (its output file, for example), and
+reports the keys (replica indices) of the markers that appear. A marker may
+also be written before the end of the cycle (e.g. a restart file written
+periodically), so it is reported each time it is written until it is
+discarded, and the caller should check that the cycle has actually ended.
+The inotify system calls are accessed through ctypes, so no additional
+packages or services are required. Note that inotify only sees changes made by the local
+kernel, therefore this is only useful when replicas run locally or write to a
+node-local filesystem.
+"""
+import os
+import sys
+import errno
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+from Queue import Queue, Empty
+
+__all__ = ['inotify_available', 'inotify_watcher']
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+def _load_libc():
+    """Return the C library if it provides inotify, otherwise None."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init
+        libc.inotify_add_watch
+    except (OSError,AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    return libc
+
+_libc = _load_libc()
+
+def inotify_available():
+    """Return True if inotify can be used on this system."""
+    return _libc is not None
+
+
+class inotify_watcher(object):
+    """
+    Watch for the appearance of completion marker files.
+
+    Markers are registered with watch(key, path, name) where path is a
+    directory and name the file expected to appear in it. A background thread
+    reads the inotify events and queues the key of a marker each time it is 
+    written (closed after writing or moved into place), until it is discarded
+    or replaced. get() blocks until at least one marker has appeared or a
+    timeout expires.
+    """
+    def __init__(self):
+        if _libc is None:
+            raise OSError('inotify is not available on this system')
+        self._fd = _libc.inotify_init()
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err,os.strerror(err))
+        self._lock = threading.Lock()
+        self._wds = {}     # directory path -> watch descriptor
+        self._paths = {}   # watch descriptor -> directory path
+        self._markers = {} # (directory path, file name) -> key
+        self._keys = {}    # key -> (directory path, file name)
+        self._events = Queue()
+        self._running = True
+        self._thread = threading.Thread(target=self._read_events)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _add_dir(self, path):
+        wd = _libc.inotify_add_watch(self._fd,path,IN_CLOSE_WRITE|IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err,'%s: %s'%(os.strerror(err),path))
+        self._wds[path] = wd
+        self._paths[wd] = path
+
+    def watch(self, key, path, name):
+        """
+        Report key when the file 'name' appears in directory 'path'. A marker
+        already registered for the same key is replaced. If the file already
+        exists the key is reported immediately.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._discard(key)
+            if path not in self._wds:
+                self._add_dir(path)
+            self._markers[(path,name)] = key
+            self._keys[key] = (path,name)
+        if os.path.exists(os.path.join(path,name)):
+            self._fire(path,name)
+
+    def _discard(self, key):
+        marker = self._keys.pop(key,None)
+        if marker is not None:
+            self._markers.pop(marker,None)
+
+    def discard(self, key):
+        """Stop watching the marker registered for key (if any)."""
+        with self._lock:
+            self._discard(key)
+
+    def _fire(self, path, name):
+        with self._lock:
+            key = self._markers.get((path,name))
+        if key is not None:
+            self._events.put(key)
+
+    def _read_events(self):
+        while self._running:
+            try:
+                ready = select.select([self._fd],[],[],1.0)[0]
+                if not ready:
+                    continue
+                buf = os.read(self._fd,65536)
+            except (OSError,select.error) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                break
+            offset = 0
+            while offset + _EVENT_HEADER.size <= len(buf):
+                wd,mask,cookie,length = _EVENT_HEADER.unpack_from(buf,offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset+length].rstrip('\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, check all of the markers directly.
+                    with self._lock:
+                        markers = self._markers.keys()
+                    for path,marker in markers:
+                        if os.path.exists(os.path.join(path,marker)):
+                            self._fire(path,marker)
+                elif not mask & IN_IGNORED:
+                    path = self._paths.get(wd)
+                    if path is not None:
+                        self._fire(path,name)
+
+    def get(self, timeout=None):
+        """
+        Return a list of the keys of the markers that have appeared. Block
+        for up to 'timeout' seconds until there is at least one.
+        """
+        keys = []
+        try:
+            keys.append(self._events.get(True,timeout))
+            while True:
+                keys.append(self._events.get_nowait())
+        except Empty:
+            pass
+        return keys
+
+    def close(self):
+        """Stop the reader thread and release the inotify descriptor."""
+        self._running = False
+        self._thread.join()
+        os.close(self._fd)
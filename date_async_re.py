@@ -1,4 +1,5 @@
 import os, sys, time
+from numpy import zeros
 from pj_async_re import async_re_job
 
 class pj_date_job(async_re_job):
@@ -43,10 +44,8 @@ class date_async_re_job(pj_date_job,async_re_job):
     def _doExchange_pair(self,repl_a,repl_b):
         pass
 
-    def _computeSwapMatrix(self, replicas, states):
-        U = [[ 0. for j in range(self.nreplicas)] 
-             for i in range(self.nreplicas)]
-        return U
+    def _computeSwapBlock(self, replicas, states, mask=None):
+        return zeros((len(states),len(replicas)))
 
 if __name__ == '__main__':
 
@@ -0,0 +1,298 @@
+"""
+Microbenchmarks of the Gibbs sampling routines and of doExchanges().
+
+Synthetic swap matrices are generated, with a seeded random number
+generator, from two energy models:
+
+us    umbrella sampling: harmonic windows evenly spaced along a coordinate,
+      U[a,i] = 0.5*k*(x_i - x_a)^2, each replica being at equilibrium in
+      the window it holds;
+bedam BEDAM-like alchemical states: U[a,i] = lambda_a*u_i, with binding
+      energies u_i whose mean and width depend on the lambda of the state
+      held by the replica.
+
+For each model and number of replicas (8 to 5000 by default) the benchmarks
+measure the wall time per exchange (one sweep of the sampler over all
+replicas), the acceptance rate (accepted swaps per replica and sweep) and
+the growth of the peak resident memory of the process:
+
+legacy   pairwise_independence_sampling() called for each replica, as
+         doExchanges() used to do (only up to --legacy-max replicas);
+dense    pairwise_independence_sweeps();
+ladder   pairwise_independence_sweeps() restricted to neighboring states;
+sparse   pairwise_independence_sweeps() restricted to swap_candidates()
+         (including the time to select them);
+sparse_ladder the same with candidates among neighboring states only;
+exchange a complete async_re_job.doExchanges() on a pool of about half of
+         the replicas, with the dense sampler (no BigJob needed).
+
+The results are written to a JSON file. Pass the file of an earlier run
+with --compare to print the relative change of every timing.
+
+Usage: python exchange_benchmark.py [options] (see --help)
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import random
+import platform
+import tempfile
+import resource
+from StringIO import StringIO
+from optparse import OptionParser
+
+import numpy
+from numpy import arange, linspace, sqrt, ix_, asarray
+from numpy.random import seed as numpy_seed, randn
+
+from gibbs_sampling import pairwise_independence_sampling, \
+    pairwise_independence_sweeps, swap_candidates
+from state_graph import ladder_neighbors
+import pj_async_re
+
+SIZES = [8, 32, 128, 512, 2000, 5000]
+MODELS = ['us', 'bedam']
+BENCHMARKS = ['legacy', 'dense', 'ladder', 'sparse', 'sparse_ladder',
+              'exchange']
+
+def us_swap_matrix(nreplicas, spacing=1., force_constant=4.):
+    """
+    Return the reduced energies U[a,i] of nreplicas umbrella sampling
+    replicas in harmonic windows 'spacing' apart (in units of kT).
+    """
+    x0 = arange(nreplicas)*spacing
+    x = x0 + randn(nreplicas)/sqrt(force_constant)
+    return 0.5*force_constant*(x[None,:] - x0[:,None])**2
+
+def bedam_swap_matrix(nreplicas, u0=-20., width=4.):
+    """
+    Return the reduced energies U[a,i] = lambda_a*u_i of nreplicas BEDAM
+    replicas at lambdas evenly spaced between 0 and 1. The binding energy
+    u_i of the replica at lambda_i is drawn from a normal distribution
+    shifted and narrowed with increasing lambda, as for a binding ligand.
+    """
+    lambdas = linspace(0.,1.,nreplicas)
+    u = u0*lambdas + width*(1.5 - lambdas)*randn(nreplicas)
+    return lambdas[:,None]*u[None,:]
+
+def swap_matrix(model, nreplicas):
+    if model == 'us':
+        return us_swap_matrix(nreplicas)
+    elif model == 'bedam':
+        return bedam_swap_matrix(nreplicas)
+    raise ValueError('Unknown energy model: %s'%model)
+
+def _maxrss():
+    """Return the peak resident memory of the process in kB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes
+        rss /= 1024
+    return rss
+
+def _timed(run, min_time):
+    """
+    Call run() (which returns the number of accepted swaps) until at least
+    min_time seconds have passed. Return the number of calls, the time per
+    call and the total number of accepted swaps.
+    """
+    ncalls = 0
+    accepted = 0
+    start_time = time.time()
+    while True:
+        accepted += run()
+        ncalls += 1
+        elapsed = time.time() - start_time
+        if elapsed >= min_time:
+            return ncalls,elapsed/ncalls,accepted
+
+def _legacy_sweep(U, replicas, states):
+    """One sweep of the original, pure python, exchange loop."""
+    Ud = dict((sid,dict(zip(replicas,U[a]))) for a,sid in enumerate(states))
+    current = dict(zip(replicas,states))
+    accepted = 0
+    for repl_i in replicas:
+        sid_i = current[repl_i]
+        curr_states = [current[repl] for repl in replicas]
+        repl_j = pairwise_independence_sampling(repl_i,sid_i,replicas,
+                                                curr_states,Ud)
+        if repl_j != repl_i:
+            current[repl_i],current[repl_j] = current[repl_j],sid_i
+            accepted += 1
+    return accepted
+
+
+class benchmark_job(pj_async_re.async_re_job):
+    """
+    An async_re_job with a synthetic swap matrix and no MD engine, pilot or
+    files other than its input file.
+    """
+    def __init__(self, command_file, U):
+        self.U = U
+        pj_async_re.async_re_job.__init__(self,command_file,None)
+        self.status = [{'stateid_current': k, 'running_status': 'W',
+                        'cycle_current': 2} for k in range(self.nreplicas)]
+
+    def _printStatus(self):
+        pass
+
+    def _write_status(self):
+        pass
+
+    def _buildInpFile(self, replica):
+        pass
+
+    def _updateStatus_replica(self, replica, restart):
+        pass
+
+    def _computeSwapBlock(self, replicas, states, mask=None):
+        # U[a,i] is the energy of the configuration of replica i, which
+        # stays the same, in state a.
+        return self.U[ix_(states,replicas)]
+
+def _exchange_runner(U, workdir):
+    nreplicas = len(U)
+    command_file = os.path.join(workdir,'benchmark.cntl')
+    f = open(command_file,'w')
+    f.write('\n'.join(['ENGINE_INPUT_BASENAME = benchmark',
+                       'WALL_TIME = 60',
+                       'COORDINATION_URL = redis://localhost',
+                       'RESOURCE_URL = fork://localhost',
+                       'BJ_WORKING_DIR = %s'%workdir,
+                       'TOTAL_CORES = %d'%nreplicas,
+                       'SUBJOB_CORES = 1',
+                       'NREPLICAS = %d'%nreplicas,
+                       'ENERGY_CACHE = no',
+                       'VERBOSE = no']) + '\n')
+    f.close()
+    job = benchmark_job(command_file,U)
+    def run():
+        # a random half of the replicas is waiting
+        for k in xrange(nreplicas):
+            if random.random() < 0.5:
+                job.status[k]['running_status'] = 'W'
+            else:
+                job.status[k]['running_status'] = 'R'
+        before = [s['stateid_current'] for s in job.status]
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            job.doExchanges()
+        finally:
+            sys.stdout = stdout
+        after = [s['stateid_current'] for s in job.status]
+        return sum(1 for a,b in zip(before,after) if a != b)
+    return run
+
+def run_benchmark(name, model, nreplicas, min_time=0.2, workdir=None):
+    """
+    Run one benchmark and return its results as a dict. The acceptance
+    rate is the number of swaps per replica and sweep (for 'exchange', the
+    fraction of all replicas changing state in an exchange).
+    """
+    U = swap_matrix(model,nreplicas)
+    perm = arange(nreplicas)
+    if name == 'legacy':
+        replicas = range(nreplicas)
+        run = lambda: _legacy_sweep(U,replicas,replicas)
+    elif name == 'dense':
+        run = lambda: pairwise_independence_sweeps(U,perm,1)
+    elif name == 'ladder':
+        neighbors = ladder_neighbors(nreplicas)
+        run = lambda: pairwise_independence_sweeps(U,perm,1,neighbors)
+    elif name == 'sparse':
+        def run():
+            candidates = swap_candidates(U)
+            return pairwise_independence_sweeps(U,perm,1,candidates)
+    elif name == 'sparse_ladder':
+        neighbors = ladder_neighbors(nreplicas)
+        def run():
+            candidates = swap_candidates(U,neighbors=neighbors)
+            return pairwise_independence_sweeps(U,perm,1,candidates)
+    elif name == 'exchange':
+        run = _exchange_runner(U,workdir)
+    else:
+        raise ValueError('Unknown benchmark: %s'%name)
+    rss = _maxrss()
+    ncalls,seconds,accepted = _timed(run,min_time)
+    return {'benchmark': name, 'model': model, 'nreplicas': nreplicas,
+            'repeats': ncalls, 'seconds_per_exchange': seconds,
+            'acceptance': accepted/float(ncalls*nreplicas),
+            'maxrss_growth_kb': _maxrss() - rss}
+
+def compare(results, reference):
+    """Print the change of the timings relative to an earlier run."""
+    old = dict(((r['benchmark'],r['model'],r['nreplicas']),r)
+               for r in reference['results'])
+    print
+    print 'Change relative to %s:'%reference.get('label','reference')
+    for r in results:
+        key = (r['benchmark'],r['model'],r['nreplicas'])
+        if key in old:
+            ratio = r['seconds_per_exchange']/old[key]['seconds_per_exchange']
+            print ('%-13s %-5s %5d  x%.2f  %s'
+                   %(key + (ratio,'SLOWER' if ratio > 1.2 else '')))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n','--nreplicas',type='int',action='append',
+                      help='number of replicas (default: %s)'
+                      %','.join(str(n) for n in SIZES))
+    parser.add_option('-m','--model',action='append',
+                      help='energy model, us or bedam (default: both)')
+    parser.add_option('-b','--benchmark',action='append',
+                      help='%s (default: all)'%', '.join(BENCHMARKS))
+    parser.add_option('--legacy-max',type='int',default=512,
+                      help='largest number of replicas for the legacy loop '
+                      '[%default]')
+    parser.add_option('--min-time',type='float',default=0.2,
+                      help='minimum time of each benchmark in seconds '
+                      '[%default]')
+    parser.add_option('--seed',type='int',default=2013,
+                      help='random number seed [%default]')
+    parser.add_option('-o','--output',default='exchange_benchmark.json',
+                      help='results file [%default]')
+    parser.add_option('--label',default=None,
+                      help='label of this run, e.g. a version')
+    parser.add_option('--compare',default=None,
+                      help='results file of an earlier run')
+    options,args = parser.parse_args()
+    sizes = options.nreplicas or SIZES
+    models = options.model or MODELS
+    benchmarks = options.benchmark or BENCHMARKS
+
+    workdir = tempfile.mkdtemp(prefix='exchange_benchmark')
+    results = []
+    print '%-13s %-5s %5s %14s %10s %12s'%('', 'model', 'n', 's/exchange',
+                                          'accepted', 'maxrss +kB')
+    try:
+        for name in benchmarks:
+            for model in models:
+                for n in sizes:
+                    if name == 'legacy' and n > options.legacy_max:
+                        continue
+                    # same matrices and random numbers for every benchmark
+                    numpy_seed(options.seed + n)
+                    random.seed(options.seed + n)
+                    r = run_benchmark(name,model,n,options.min_time,workdir)
+                    results.append(r)
+                    print ('%-13s %-5s %5d %14.6f %10.3f %12d'
+                           %(name,model,n,r['seconds_per_exchange'],
+                             r['acceptance'],r['maxrss_growth_kb']))
+                    sys.stdout.flush()
+    finally:
+        shutil.rmtree(workdir,ignore_errors=True)
+
+    output = {'label': options.label or time.strftime('%Y-%m-%d %H:%M'),
+              'date': time.asctime(), 'seed': options.seed,
+              'asyncre_version': pj_async_re.__version__,
+              'python': platform.python_version(),
+              'numpy': numpy.__version__, 'machine': platform.platform(),
+              'results': results}
+    f = open(options.output,'w')
+    json.dump(output,f,indent=1)
+    f.close()
+    print 'Results written to %s'%options.output
+    if options.compare is not None:
+        compare(results,json.load(open(options.compare,'r')))
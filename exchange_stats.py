@@ -0,0 +1,316 @@
+"""
+Statistics of the replica exchanges of an asynchronous RE job.
+
+An exchange_stats object is updated with the outcome of every exchange
+(the states of the waiting replicas before and after it) and accumulates:
+
+- the number of exchanges in which each pair of states was in the pool of
+  waiting replicas (attempted) and in which a replica moved from the first
+  to the second (accepted);
+- the state trajectory of each replica, as a list of state changes;
+- the round trips of the replicas between two end states (e.g. the lowest
+  and highest temperature or lambda), in replica cycles and in exchanges;
+- the mean size of the pool of waiting replicas.
+
+All of the counters are numpy arrays, so that an update costs about as
+much as indexing the swap matrix of the waiting replicas. The counters,
+whose size does not grow with the length of the run, are saved with the
+checkpoint of the job (see state()/restore()). The trajectories and the
+round trips grow with every exchange, so they are instead kept in memory
+or, once open_log() is called, appended in batches to a binary log file
+(BASENAME_exchanges.dat) of int32 records (kind, a, b, c, d): kind 0 for a
+state change (exchange, replica, cycle, state) and kind 1 for a round trip
+(replica, cycles, exchanges, 0). All of the statistics can be exported in
+compressed .npz format with save(), also from the command line:
+
+python exchange_stats.py BASENAME.stat [output.npz]
+"""
+import os
+import sys
+import pickle
+
+from numpy import zeros, ones, asarray, arange, ix_, concatenate, \
+    column_stack, savez_compressed, int32, fromfile
+
+_EVENT, _TRIP = 0, 1
+
+__all__ = ['exchange_stats']
+
+class exchange_stats(object):
+    """
+    Accumulate exchange statistics for nstates states and nreplicas
+    replicas (by default as many as states). Round trips are counted between
+    the two states in 'end_states', by default the first and the last. Log
+    records are written every 'buffer_size' records and by state().
+    """
+    def __init__(self, nstates, nreplicas=None, end_states=None, 
+                 buffer_size=4096):
+        if nreplicas is None:
+            nreplicas = nstates
+        if end_states is None:
+            end_states = (0,nstates-1)
+        self.nstates = nstates
+        self.nreplicas = nreplicas
+        self.end_states = tuple(end_states)
+        self.nexchanges = 0
+        self.pool_size_sum = 0
+        self.attempted = zeros((nstates,nstates),dtype=int32)
+        self.accepted = zeros((nstates,nstates),dtype=int32)
+        # last end state visited by each replica (0 or 1, -1 for none) and
+        # the cycle and exchange in which the current round trip started
+        self.last_end = -ones(nreplicas,dtype=int)
+        self.trip_start = -ones((nreplicas,2),dtype=int)
+        self.ntrips = 0
+        self.trip_cycles_sum = 0
+        self._trips = []  # arrays of (replica, cycles, exchanges) rows
+        self._events = [] # arrays of (exchange, replica, cycle, state) rows
+        # log file, records in it (and in the buffer) and buffered records
+        self.filename = None
+        self.buffer_size = buffer_size
+        self.nrecords = 0
+        self._buffer = []
+
+    def open_log(self, filename, new=False, append=True):
+        """
+        Write the trajectories and round trips to the log 'filename' from
+        now on, starting with those in memory. An existing log is continued
+        unless 'new' is True; its records beyond those counted by the
+        restored statistics (written after the last checkpoint) are dropped.
+        If 'append' is False the log is only read.
+        """
+        self.filename = filename
+        if not append:
+            return
+        if new or not os.path.exists(filename):
+            self.nrecords = 0
+            open(filename,'wb').close()
+        else:
+            self.nrecords = min(self.nrecords,os.path.getsize(filename)/20)
+            f = open(filename,'r+b')
+            try:
+                f.truncate(20*self.nrecords)
+            finally:
+                f.close()
+        for kind,rows in [(_EVENT,self._events),(_TRIP,self._trips)]:
+            for r in rows:
+                self._log(kind,r)
+        self._events = []
+        self._trips = []
+
+    def _log(self, kind, rows):
+        """Buffer log records of the given kind for rows of 4 or 3 ints."""
+        records = zeros((len(rows),5),dtype=int32)
+        records[:,0] = kind
+        records[:,1:1+rows.shape[1]] = rows
+        self._buffer.append(records)
+        self.nrecords += len(rows)
+        if sum([len(b) for b in self._buffer]) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to the log."""
+        if not self._buffer:
+            return
+        f = open(self.filename,'ab')
+        concatenate(self._buffer).tofile(f)
+        f.close()
+        self._buffer = []
+
+    def _read_log(self, kind):
+        """Return the rows of the given kind in the log (and the buffer)."""
+        self.flush()
+        f = open(self.filename,'rb')
+        try:
+            records = fromfile(f,dtype=int32,count=5*self.nrecords)
+        finally:
+            f.close()
+        records = records[:len(records)/5*5].reshape((-1,5))
+        return records[records[:,0] == kind,1:]
+
+    def update(self, replicas, states_before, states_after, cycles):
+        """
+        Record an exchange among the given replicas, which were in
+        states_before and are now in states_after, at the given cycles.
+        """
+        replicas = asarray(replicas,dtype=int)
+        before = asarray(states_before,dtype=int)
+        after = asarray(states_after,dtype=int)
+        cycles = asarray(cycles,dtype=int)
+        self.nexchanges += 1
+        self.pool_size_sum += len(replicas)
+        self.attempted[ix_(before,before)] += 1
+        # states are unique within the pool, so are the (before,after) pairs
+        self.accepted[before,after] += 1
+
+        moved = before != after
+        if moved.any():
+            exchange = zeros(moved.sum(),dtype=int) + self.nexchanges
+            events = column_stack((exchange,replicas[moved],cycles[moved],
+                                   after[moved]))
+            if self.filename is None:
+                self._events.append(events)
+            else:
+                self._log(_EVENT,events)
+
+        low,high = self.end_states
+        at_low = after == low
+        repl = replicas[at_low]
+        now = column_stack((cycles[at_low],
+                            zeros(len(repl),dtype=int) + self.nexchanges))
+        arrived = self.last_end[repl] != 0
+        done = (self.last_end[repl] == 1) & (self.trip_start[repl,0] >= 0)
+        if done.any():
+            trips = now[done] - self.trip_start[repl[done]]
+            self.ntrips += len(trips)
+            self.trip_cycles_sum += int(trips[:,0].sum())
+            trips = column_stack((repl[done],trips))
+            if self.filename is None:
+                self._trips.append(trips)
+            else:
+                self._log(_TRIP,trips)
+        self.trip_start[repl[arrived]] = now[arrived]
+        self.last_end[repl] = 0
+        repl = replicas[after == high]
+        self.last_end[repl[self.last_end[repl] == 0]] = 1
+
+    @property
+    def mean_pool_size(self):
+        return self.pool_size_sum/float(max(1,self.nexchanges))
+
+    @property
+    def acceptance(self):
+        """Fraction of attempted state to state transitions accepted."""
+        return self.accepted/asarray(self.attempted,dtype=float).clip(1)
+
+    @property
+    def trajectories(self):
+        """
+        Return the state changes of all replicas as an array of (exchange,
+        replica, cycle, new state) rows.
+        """
+        if self.filename is not None:
+            return self._read_log(_EVENT)
+        if not self._events:
+            return zeros((0,4),dtype=int)
+        events = concatenate(self._events)
+        self._events = [events]
+        return events
+
+    @property
+    def round_trips(self):
+        """
+        Return the completed round trips as (replica, cycles, exchanges) 
+        rows.
+        """
+        if self.filename is not None:
+            return self._read_log(_TRIP)[:,:3]
+        if not self._trips:
+            return zeros((0,3),dtype=int)
+        trips = concatenate(self._trips)
+        self._trips = [trips]
+        return trips
+
+    def summary(self):
+        """Return a one line summary of the statistics."""
+        n = self.nstates
+        if n > 1:
+            up = self.acceptance[arange(n-1),arange(1,n)]
+            down = self.acceptance[arange(1,n),arange(n-1)]
+            neighbor = 0.5*(up + down).mean()
+        else:
+            neighbor = 0.
+        mean_trip = self.trip_cycles_sum/float(max(1,self.ntrips))
+        return ('%d exchanges, mean pool size %.1f, neighbor state acceptance '
+                '%.3f, %d round trips (mean %.1f cycles)'
+                %(self.nexchanges,self.mean_pool_size,neighbor,self.ntrips,
+                  mean_trip))
+
+    def state(self):
+        """
+        Return the counters as a dict of numbers and arrays, with the number
+        of log records that they account for, after writing these records.
+        The trajectories and round trips are included only if there is no
+        log.
+        """
+        state = {'nstates': self.nstates, 'nreplicas': self.nreplicas,
+                 'end_states': asarray(self.end_states),
+                 'nexchanges': self.nexchanges,
+                 'pool_size_sum': self.pool_size_sum,
+                 'mean_pool_size': self.mean_pool_size,
+                 'attempted': self.attempted, 'accepted': self.accepted,
+                 'last_end': self.last_end, 'trip_start': self.trip_start,
+                 'ntrips': self.ntrips, 
+                 'trip_cycles_sum': self.trip_cycles_sum}
+        if self.filename is None:
+            state['round_trips'] = self.round_trips
+            state['trajectories'] = self.trajectories
+        else:
+            self.flush()
+            state['nrecords'] = self.nrecords
+        return state
+
+    def restore(self, state):
+        """
+        Restore statistics returned by state() (call it before open_log()).
+        They are ignored if they were collected for a different number of
+        states or replicas.
+        """
+        if (state.get('nstates') != self.nstates or
+            state.get('nreplicas') != self.nreplicas):
+            return False
+        self.end_states = tuple(state['end_states'])
+        self.nexchanges = int(state['nexchanges'])
+        self.pool_size_sum = int(state['pool_size_sum'])
+        self.attempted = asarray(state['attempted'],dtype=int32)
+        self.accepted = asarray(state['accepted'],dtype=int32)
+        self.last_end = asarray(state['last_end'],dtype=int)
+        self.trip_start = asarray(state['trip_start'],dtype=int)
+        self.nrecords = int(state.get('nrecords',0))
+        if 'round_trips' in state:
+            self._trips = [asarray(state['round_trips'],dtype=int)]
+            self._events = [asarray(state['trajectories'],dtype=int)]
+        trips = self.round_trips
+        self.ntrips = int(state.get('ntrips',len(trips)))
+        self.trip_cycles_sum = int(state.get('trip_cycles_sum',
+                                             trips[:,1].sum()))
+        return True
+
+    def save(self, filename):
+        """
+        Export the statistics, with the trajectories and round trips, to a 
+        compressed .npz file.
+        """
+        state = self.state()
+        state['round_trips'] = self.round_trips
+        state['trajectories'] = self.trajectories
+        savez_compressed(filename,**state)
+
+if __name__ == '__main__':
+    try:
+        status_file = sys.argv[1]
+    except IndexError:
+        print 'usage: exchange_stats.py BASENAME.stat [output.npz]'
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        output = sys.argv[2]
+    else:
+        output = status_file.rsplit('.',1)[0] + '_exchange_stats.npz'
+    f = open(status_file,'rb')
+    status = pickle.load(f)
+    try:
+        checkpoint = pickle.load(f)
+    except EOFError:
+        checkpoint = {}
+    f.close()
+    if checkpoint.get('exchange_stats') is None:
+        print 'No exchange statistics in %s'%status_file
+        sys.exit(1)
+    state = checkpoint['exchange_stats']
+    stats = exchange_stats(state['nstates'],state['nreplicas'])
+    stats.restore(state)
+    if 'nrecords' in state:
+        stats.open_log(status_file.rsplit('.',1)[0] + '_exchanges.dat',
+                       append=False)
+    print stats.summary()
+    stats.save(output)
+    print 'Written %s'%output
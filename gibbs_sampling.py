@@ -1,5 +1,7 @@
 """Gibbs sampling routines"""
-from numpy import zeros, exp, sum, log, asarray
+from numpy import zeros, exp, sum, log, asarray, arange, maximum, ix_, \
+    ndarray, empty, fill_diagonal, argpartition, ones, inf, minimum, dot, \
+    float32, where, isinf, concatenate
 from numpy.random import random as _random
 from random import choice
 from itertools import permutations
@@ -114,6 +116,286 @@ def pairwise_independence_sampling(repl_i, sid_i, replicas, states, U):
               'list of waiting replicas?'%i)
     return replicas[weighted_choice(zip(range(nreplicas),ps))]
 
+def swap_block(U, replicas, states):
+    """
+    Return, as a k x k array, the block of a full swap matrix 
+    U[stateid][replica] (a list of lists or an array) belonging to the given
+    k states (rows) and k replicas (columns).
+    """
+    if isinstance(U,ndarray):
+        return U[ix_(states,replicas)].astype(float)
+    return asarray([[U[sid][repl] for repl in replicas] for sid in states],
+                   dtype=float)
+
+def pairwise_independence_sweeps(U, perm, nsweeps=1, neighbors=None):
+    """
+    Vectorized version of repeated pairwise_independence_sampling() over a 
+    set of k replicas. Return the number of accepted exchanges.
+
+    U is a k x k array of reduced energies restricted to the replicas being 
+    exchanged: U[a,i] is the energy of replica i in state a, where both 
+    replicas and states are numbered 0 to k-1 (in practice, state a is the
+    one initially held by replica a). perm is an integer array such that 
+    perm[i] is the state currently held by replica i; it is updated in place.
+
+    In each of the 'nsweeps' sweeps every replica i, in order, is swapped 
+    with a replica j (possibly itself) drawn from the same transition matrix 
+    as in pairwise_independence_sampling(). The energy differences of all 
+    the possible swaps are computed at once with fancy indexing and j is 
+    drawn by bisection of the cumulative swap probabilities. The sequence of 
+    random numbers is the same as in repeated calls to 
+    pairwise_independence_sampling().
+
+    If a state graph is given ('neighbors', see state_graph.py, numbered
+    like the rows of U) replica i may only swap with the replicas holding
+    states adjacent to its own. Each of these swaps is proposed with the 
+    same probability f = 1/d, d being the largest number of neighbors of any
+    state, so that detailed balance holds and the cost of a sweep is O(k*d)
+    rather than O(k^2). Only elements U[a,j] such that replica j can reach
+    a state connected to a are accessed.
+    """
+    U = asarray(U,dtype=float)
+    nreplicas = len(perm)
+    if nreplicas < 2:
+        return 0
+    if neighbors is not None:
+        return _neighbor_sweeps(U,perm,nsweeps,neighbors)
+    f = 1./(float(nreplicas) - 1.)
+    replicas = arange(nreplicas)
+    accepted = 0
+    for sweep in xrange(nsweeps):
+        for i in xrange(nreplicas):
+            sid_i = perm[i]
+            # du[j] = u_a(j) + u_b(i) - u_a(i) - u_b(j),
+            # a = perm[i], b = perm[j]
+            du = U[sid_i] + U[perm,i] - U[sid_i,i] - U[perm,replicas]
+            ps = f*exp(-maximum(du,0.)) # f*min[1,exp(-du)]
+            ps[i] = 0.
+            ps[i] = 1. - ps.sum()
+            cps = ps.cumsum()
+            j = cps.searchsorted(_random()*cps[-1],side='right')
+            if j >= nreplicas: # You should never get here.
+                j = nreplicas - 1
+            if j != i:
+                perm[i] = perm[j]
+                perm[j] = sid_i
+                accepted += 1
+    return accepted
+
+def swap_candidates(U, threshold=1e-12, max_candidates=None, 
+                    neighbors=None, mask=None):
+    """
+    Return a sparse state graph (see state_graph.py) of the pairs of states 
+    worth exchanging.
+
+    U is as in pairwise_independence_sweeps(). Since only differences 
+    u_a(x_j) - u_a(x_i) enter the swap probabilities, the energies in each 
+    state are taken relative to their minimum, W[a,i] = U[a,i] - min_j 
+    U[a,j]. Two states are candidates if some replica is within 
+    -log(threshold) of the minimum in both; the swaps of any other pair 
+    require at least one replica to move to a state where its (relative) 
+    energy exceeds this. If max_candidates is given each state also keeps 
+    only its max_candidates best partners (found with argpartition), ranked 
+    by the lowest such energy, and the pairs selected by either state are 
+    kept. If a state graph ('neighbors') is given only its pairs are 
+    considered, at a cost of O(k^2*d) for k states of at most d neighbors,
+    in a few vectorized operations. Otherwise building the graph costs at 
+    least O(k^2), and up to O(k^3) if most replicas are near most states 
+    (e.g. BEDAM), which can be more than a dense sweep saves: this is mainly 
+    useful with a state graph or with many sweeps per exchange. 
+
+    If a boolean 'mask' is given only the energies U[a,i] where it is True 
+    are used (the others may not have been computed, see
+    async_re_job._cachedSwapBlock()), both for the minima and the pairs.
+
+    The graph depends on the energies but not on which replica holds which 
+    state, so sampling the swaps it allows leaves the Boltzmann distribution 
+    of the permutations reachable through it exact.
+    """
+    U = asarray(U,dtype=float)
+    nstates = len(U)
+    if mask is not None:
+        U = where(mask,U,inf)
+    Umin = U.min(axis=1)
+    Umin[isinf(Umin)] = 0.
+    W = U - Umin[:,None]
+    near = W <= -log(max(threshold,1e-300))
+    if neighbors is not None:
+        # scores are only needed if a state has more neighbors than that
+        scored = (max_candidates is not None and
+                  max_candidates < max([len(nbrs) for nbrs in neighbors]))
+        keep,score = _neighbor_candidates(W,near,neighbors,scored)
+        return _select_candidates(keep,score,max_candidates)
+    # Each replica connects the states where its energy is low, at a cost 
+    # of the square of their number. If replicas are close to most states
+    # a (BLAS) matrix product is faster.
+    nnear = near.sum(axis=0)
+    if (nnear**2).sum() > nstates**3/20:
+        near_f = near.astype(float32)
+        keep = dot(near_f,near_f.T) > 0.5
+    else:
+        keep = zeros((nstates,nstates),dtype=bool)
+        for i in (nnear > 1).nonzero()[0]:
+            s = near[:,i].nonzero()[0]
+            keep[ix_(s,s)] = True
+    if max_candidates is not None:
+        score = empty((nstates,nstates))
+        score.fill(inf)
+        for i in (nnear > 1).nonzero()[0]:
+            s = near[:,i].nonzero()[0]
+            w = W[s,i]
+            score[ix_(s,s)] = minimum(score[ix_(s,s)],
+                                      maximum(w[:,None],w[None,:]))
+    else:
+        score = None
+    fill_diagonal(keep,False)
+    return _select_candidates(keep,score,max_candidates)
+
+def _neighbor_candidates(W, near, neighbors, scored, chunk=1<<20):
+    """
+    Return the pairs of neighboring states of swap_candidates() (as a 
+    boolean matrix) and, if 'scored', their scores. The pairs are processed
+    in chunks of about 'chunk' (pair, replica) elements.
+    """
+    nstates,nreplicas = W.shape
+    keep = zeros((nstates,nstates),dtype=bool)
+    score = None
+    if scored:
+        score = empty((nstates,nstates))
+        score.fill(inf)
+    first = concatenate([zeros(len(nbrs),dtype=int) + a 
+                         for a,nbrs in enumerate(neighbors)])
+    second = concatenate([asarray(nbrs,dtype=int) for nbrs in neighbors])
+    edges = first != second
+    first,second = first[edges],second[edges]
+    step = max(1,chunk/max(1,nreplicas))
+    for n in xrange(0,len(first),step):
+        a,b = first[n:n+step],second[n:n+step]
+        both = near[a] & near[b]
+        keep[a,b] = both.any(axis=1)
+        if scored:
+            score[a,b] = where(both,maximum(W[a],W[b]),inf).min(axis=1)
+    return keep,score
+
+def _select_candidates(keep, score, max_candidates):
+    """
+    Return the candidate lists of swap_candidates() from the boolean matrix
+    of the pairs kept, limited to max_candidates per state (if not None) by
+    their scores.
+    """
+    nstates = len(keep)
+    candidates = [row.nonzero()[0] for row in keep]
+    if max_candidates is not None:
+        top = zeros((nstates,nstates),dtype=bool)
+        for a,cand in enumerate(candidates):
+            if len(cand) > max_candidates:
+                cand = cand[argpartition(score[a,cand],max_candidates)
+                            [:max_candidates]]
+            top[a,cand] = True
+        keep &= top | top.T
+        candidates = [row.nonzero()[0] for row in keep]
+    return candidates
+
+def pruned_swap_probability(U, perm, candidates, neighbors=None):
+    """
+    Return the largest total probability, over all replicas, of the swaps 
+    that the unrestricted sampler (or the one restricted to 'neighbors') 
+    would propose and accept, in the current permutation, but that are not
+    in the 'candidates' graph.
+    """
+    U = asarray(U,dtype=float)
+    nstates = len(perm)
+    if nstates < 2:
+        return 0.
+    occ = empty(nstates,dtype=int)
+    occ[perm] = arange(nstates)
+    # V[a,b] is the energy in state a of the replica holding state b
+    V = U[:,occ]
+    d = V.diagonal()
+    pruned = zeros(nstates)
+    if neighbors is None:
+        f = 1./(float(nstates) - 1.)
+        allowed = [arange(nstates)]*nstates
+    else:
+        f = 1./float(max(1,max(len(nbrs) for nbrs in neighbors)))
+        allowed = neighbors
+    for a,(nbrs,cand) in enumerate(zip(allowed,candidates)):
+        mask = ones(len(nbrs),dtype=bool)
+        mask[nbrs.searchsorted(cand)] = False
+        nbrs = nbrs[mask & (nbrs != a)]
+        du = V[a,nbrs] + V[nbrs,a] - d[a] - d[nbrs]
+        pruned[a] = f*exp(-maximum(du,0.)).sum()
+    return pruned.max()
+
+def adaptive_sweeps(sweep, perm, max_sweeps, tol=0.01, patience=2, 
+                    info=None):
+    """
+    Repeat exchange sweeps until the permutation stops evolving. Return the
+    number of accepted exchanges.
+
+    'sweep' is a function performing n sweeps over the permutation 'perm'
+    (updated in place, see pairwise_independence_sweeps()) and returning 
+    the number of accepted exchanges. After each sweep the fraction of 
+    replicas that are no longer in their initial state is computed; the 
+    sweeps stop once it has changed by less than 'tol' for 'patience' 
+    consecutive sweeps, or after 'max_sweeps' sweeps. If a dict is passed 
+    as 'info' it receives the number of sweeps ('nsweeps'), the final 
+    fraction of moved replicas ('moved') and the fraction of replicas 
+    exchanged in the last sweep ('change_rate').
+    """
+    initial = perm.copy()
+    nreplicas = max(1,len(perm))
+    accepted = 0
+    nsweeps = 0
+    moved = 0.
+    change_rate = 0.
+    nflat = 0
+    while nsweeps < max_sweeps and nflat < patience:
+        naccepted = sweep(1)
+        accepted += naccepted
+        nsweeps += 1
+        change_rate = naccepted/float(nreplicas)
+        last_moved,moved = moved,(perm != initial).mean()
+        if abs(moved - last_moved) < tol:
+            nflat += 1
+        else:
+            nflat = 0
+    if info is not None:
+        info['nsweeps'] = nsweeps
+        info['moved'] = moved
+        info['change_rate'] = change_rate
+    return accepted
+
+def _neighbor_sweeps(U, perm, nsweeps, neighbors):
+    dmax = max(len(nbrs) for nbrs in neighbors)
+    if dmax == 0:
+        return 0
+    f = 1./float(dmax)
+    # occ[a] is the replica currently holding state a
+    occ = empty(len(perm),dtype=int)
+    occ[perm] = arange(len(perm))
+    accepted = 0
+    for sweep in xrange(nsweeps):
+        for i in xrange(len(perm)):
+            sid_i = perm[i]
+            nbrs = neighbors[sid_i]
+            if len(nbrs) == 0:
+                continue
+            js = occ[nbrs]
+            du = U[sid_i,js] + U[nbrs,i] - U[sid_i,i] - U[nbrs,js]
+            # The total swap probability is at most one, the remainder is
+            # the probability of no exchange.
+            cps = (f*exp(-maximum(du,0.))).cumsum()
+            n = cps.searchsorted(_random(),side='right')
+            if n < len(nbrs):
+                j = js[n]
+                perm[i] = nbrs[n]
+                perm[j] = sid_i
+                occ[nbrs[n]] = i
+                occ[sid_i] = j
+                accepted += 1
+    return accepted
+
 def state_perm_distribution(replicas, states, swap_matrix):
     """
     Return the distribution of state permutations of a set of replicas (and 
@@ -0,0 +1,372 @@
+"""
+Validation of the Gibbs sampling routines at production sizes.
+
+Enumerating the n! permutations of n replicas (see state_perm_distribution()
+in gibbs_sampling.py) is only possible for a handful of replicas. Here the
+samplers are instead run on synthetic swap matrices made of many small
+blocks of replicas and states (up to 6), with a large energy penalty for a
+replica of one block to be in a state of another. The distribution of the
+permutations then factorizes into independent blocks, each small enough to
+be enumerated exactly, so that the exact marginal occupancies of the states
+by the replicas and the exact probabilities of the state transitions of
+the replicas in one sweep are available for hundreds of replicas.
+
+Each sample is one sweep started from a permutation drawn from the exact
+distribution, and only one replica of each block, drawn at random, is
+counted in each sample (the replicas of a block move together), so that
+counts are independent and chi-square statistics apply: the states after
+the sweep must still follow the exact distribution and the transitions
+must follow those of the exact transition matrix of a sweep.
+Kullback-Liebler divergences of the observed and exact marginals are also
+reported. A sampler fails if either chi-square statistic has a p-value
+below 1e-4.
+
+Usage: python gibbs_validation.py [options] (see --help)
+"""
+import sys
+import time
+from math import lgamma
+from itertools import permutations
+from optparse import OptionParser
+
+from numpy import zeros, ones, exp, log, asarray, arange, eye, \
+    maximum, minimum, dot, bincount, where
+from numpy.random import random, seed as random_seed, randn
+
+from gibbs_sampling import pairwise_independence_sweeps, swap_candidates
+from state_graph import ladder_neighbors
+
+__all__ = ['block_swap_matrix', 'block_permutation_distribution',
+           'block_sweep_matrix', 'sampler', 'exact_statistics',
+           'sample_statistics', 'chi_square', 'chi_square_pvalue',
+           'kl_divergence', 'validate']
+
+def block_swap_matrix(nblocks, block_size, spacing=1., penalty=1e4):
+    """
+    Return a synthetic k x k swap matrix, k = nblocks*block_size, of
+    umbrella sampling-like reduced energies U[a,i] = (x_i - x_a)^2/spacing^2
+    in each block and U[a,i] = penalty between blocks. x_a is the position
+    of state a along a line and x_i that of the replica initially in it,
+    randomly displaced around x_a.
+    """
+    nstates = nblocks*block_size
+    x0 = arange(nstates)*spacing
+    x = x0 + 0.5*spacing*randn(nstates)
+    U = (x[None,:] - x0[:,None])**2/spacing**2
+    block = arange(nstates)/block_size
+    U[block[:,None] != block[None,:]] = penalty
+    return U
+
+def block_permutation_distribution(Ub):
+    """
+    Return the permutations (as an array, perms[p,i] being the state of
+    replica i in permutation p) of a b x b block of a swap matrix and their
+    exact probabilities.
+    """
+    b = len(Ub)
+    perms = asarray(list(permutations(range(b))),dtype=int)
+    u = Ub[perms,arange(b)[None,:]].sum(axis=1)
+    p = exp(-(u - u.min()))
+    return perms,p/p.sum()
+
+def block_sweep_matrix(Ub, perms, f, adjacent=None):
+    """
+    Return the exact transition matrix between the permutations of a block
+    of replicas for one sweep of pairwise_independence_sweeps(): each of the
+    b replicas in turn attempts a swap with any replica whose state is
+    adjacent to its own (all of them if 'adjacent' is None), each swap
+    being proposed with probability f.
+    """
+    b = len(Ub)
+    nperms = len(perms)
+    if adjacent is None:
+        adjacent = ones((b,b),dtype=bool)
+    index = dict((tuple(perm),p) for p,perm in enumerate(perms))
+    K = eye(nperms)
+    for i in xrange(b):
+        S = zeros((nperms,nperms))
+        for p,perm in enumerate(perms):
+            for j in xrange(b):
+                a,c = perm[i],perm[j]
+                if j == i or not adjacent[a,c]:
+                    continue
+                du = Ub[a,j] + Ub[c,i] - Ub[a,i] - Ub[c,j]
+                new = perm.copy()
+                new[i],new[j] = c,a
+                S[p,index[tuple(new)]] += f*exp(-max(du,0.))
+            S[p,p] = 1. - S[p].sum()
+        K = dot(K,S)
+    return K
+
+def sampler(U, name, block_size=None):
+    """
+    Return a sweep function sweep(perm) for one of the samplers 'dense',
+    'ladder' (restricted to neighboring states) or 'sparse' (restricted to
+    swap candidates), the proposal probability f of a swap and the state
+    graph (None if any two states can be swapped).
+
+    If block_size is given the dense sampler is run on each block of U in
+    turn, with f = 1/(block_size - 1). Swaps between blocks are always
+    rejected, so this samples the same distribution, but over all k
+    replicas f = 1/(k - 1) and a sweep moves too few replicas for their
+    transitions to be tested with a practical number of samples.
+    """
+    nstates = len(U)
+    if name == 'dense':
+        neighbors = None
+        if block_size is None:
+            f = 1./(nstates - 1.)
+            sweep = lambda perm: pairwise_independence_sweeps(U,perm,1)
+        else:
+            f = 1./(block_size - 1.)
+            sweep = lambda perm: _block_sweeps(U,perm,block_size)
+        return sweep,f,neighbors
+    elif name == 'ladder':
+        neighbors = ladder_neighbors(nstates)
+    elif name == 'sparse':
+        neighbors = swap_candidates(U)
+    else:
+        raise ValueError('Unknown sampler: %s'%name)
+    if neighbors is not None:
+        f = 1./max(len(nbrs) for nbrs in neighbors)
+    sweep = lambda perm: pairwise_independence_sweeps(U,perm,1,neighbors)
+    return sweep,f,neighbors
+
+def _block_sweeps(U, perm, block_size):
+    """
+    Run one sweep of pairwise_independence_sweeps() on each block of
+    replicas and states of U, perm being updated in place. Return the
+    number of accepted exchanges.
+    """
+    accepted = 0
+    for start in xrange(0,len(perm),block_size):
+        s = slice(start,start+block_size)
+        local = perm[s] - start
+        accepted += pairwise_independence_sweeps(U[s,s],local,1)
+        perm[s] = local + start
+    return accepted
+
+def exact_statistics(U, block_size, f, neighbors=None):
+    """
+    Return the exact statistics of the permutations of the blocks of a
+    swap matrix: the permutations and their probabilities for each block,
+    as arrays, the marginal occupancies P[i,a] of the states a of its block
+    by each replica i and the joint probabilities T[i,a,c] that replica i
+    is in state a before a sweep and in state c after it (state indices are
+    relative to the block).
+    """
+    nstates = len(U)
+    nblocks = nstates/block_size
+    allp = []
+    P = zeros((nstates,block_size))
+    T = zeros((nstates,block_size,block_size))
+    onehot = eye(block_size)
+    for n in xrange(nblocks):
+        s = slice(n*block_size,(n+1)*block_size)
+        Ub = U[s,s]
+        perms,p = block_permutation_distribution(Ub)
+        adjacent = None
+        if neighbors is not None:
+            adjacent = zeros((block_size,block_size),dtype=bool)
+            for a in xrange(block_size):
+                nbrs = neighbors[n*block_size+a] - n*block_size
+                adjacent[a,nbrs[(nbrs >= 0) & (nbrs < block_size)]] = True
+        J = p[:,None]*block_sweep_matrix(Ub,perms,f,adjacent)
+        for i in xrange(block_size):
+            A = onehot[perms[:,i]] # (nperms, block_size)
+            P[n*block_size+i] = dot(p,A)
+            T[n*block_size+i] = dot(A.T,dot(J,A))
+        allp.append(p)
+    return asarray(allp),P,T,perms
+
+def sample_statistics(sweep, block_probs, perms, nsamples):
+    """
+    Return the observed counts of the states of the replicas after one
+    sweep, N[i,c], and of their transitions, C[i,a,c], over 'nsamples'
+    sweeps each started from a permutation drawn from the exact
+    distribution of each block. In each sweep only one replica of each
+    block, drawn at random, is counted.
+    """
+    nblocks,nperms = block_probs.shape
+    block_size = perms.shape[1]
+    nstates = nblocks*block_size
+    cum = block_probs.cumsum(axis=1)
+    offset = (arange(nblocks)*block_size).repeat(block_size)
+    replica = arange(nstates)
+    C = zeros(nstates*block_size*block_size,dtype=int)
+    for n in xrange(nsamples):
+        draw = (cum < random(nblocks)[:,None]*cum[:,-1:]).sum(axis=1)
+        draw[draw >= nperms] = nperms - 1
+        start = perms[draw].ravel() + offset
+        perm = start.copy()
+        sweep(perm)
+        cell = (replica*block_size + start - offset)*block_size + perm - offset
+        counted = minimum((random(nblocks)*block_size).astype(int),
+                          block_size - 1) + offset[::block_size]
+        C += bincount(cell[counted],minlength=len(C))
+    C = C.reshape((nstates,block_size,block_size))
+    return C.sum(axis=1),C
+
+def chi_square(observed, expected, min_expected=5.):
+    """
+    Return the chi-square statistic of observed and expected counts (arrays
+    of any shape, the last axis being the categories of each independent
+    multinomial), the number of degrees of freedom and the p-value of the
+    statistic (see chi_square_pvalue()). As usual, the categories expected 
+    less than min_expected times are pooled, and the pool is merged with the
+    least expected other category if it is itself expected less than 
+    min_expected times (so that the counts of each multinomial still add up
+    to its total). Multinomials expected less than min_expected times in
+    all are ignored.
+    """
+    m = asarray(observed).shape[-1]
+    observed = asarray(observed,dtype=float).reshape((-1,m))
+    expected = asarray(expected,dtype=float).reshape((-1,m))
+    chi2 = 0.
+    dof = 0
+    for obs,exp_ in zip(observed,expected):
+        small = exp_ < min_expected
+        o = list(obs[~small])
+        e = list(exp_[~small])
+        if small.any():
+            o.append(obs[small].sum())
+            e.append(exp_[small].sum())
+            if e[-1] < min_expected and len(e) > 1:
+                k = e.index(min(e[:-1]))
+                o[k] += o.pop()
+                e[k] += e.pop()
+        if len(e) < 2:
+            continue
+        o = asarray(o)
+        e = asarray(e)
+        chi2 += ((o - e)**2/e).sum()
+        dof += len(e) - 1
+    return chi2,dof,chi_square_pvalue(chi2,dof)
+
+def chi_square_pvalue(chi2, dof, eps=1e-14, maxiter=100000):
+    """
+    Return the probability that a chi-square variable with 'dof' degrees of
+    freedom exceeds chi2, the regularized upper incomplete gamma function
+    Q(dof/2, chi2/2), computed with its series for x < a + 1 and with its
+    continued fraction (modified Lentz's method) otherwise, as in Numerical
+    Recipes. Unlike the normal approximation, this holds for few degrees of
+    freedom.
+    """
+    if dof <= 0:
+        return 1.
+    a = 0.5*dof
+    x = 0.5*chi2
+    if x <= 0.:
+        return 1.
+    prefactor = exp(-x + a*log(x) - lgamma(a))
+    if x < a + 1.:
+        term = total = 1./a
+        for n in xrange(1,maxiter):
+            term *= x/(a + n)
+            total += term
+            if term < eps*total:
+                break
+        return max(0.,1. - prefactor*total)
+    tiny = 1e-300
+    b = x + 1. - a
+    c = 1./tiny
+    d = 1./b
+    h = d
+    for n in xrange(1,maxiter):
+        an = -n*(n - a)
+        b += 2.
+        d = an*d + b
+        if abs(d) < tiny:
+            d = tiny
+        c = b + an/c
+        if abs(c) < tiny:
+            c = tiny
+        d = 1./d
+        delta = d*c
+        h *= delta
+        if abs(delta - 1.) < eps:
+            break
+    return prefactor*h
+
+def kl_divergence(p, q, eps=1e-9):
+    """
+    Return the Kullback-Liebler divergences of the rows (last axis) of two
+    arrays of discrete probability distributions (see
+    discrete_Kullback_Liebler_divergence() in gibbs_sampling.py).
+    """
+    p = maximum(asarray(p,dtype=float),eps)
+    q = asarray(q,dtype=float)
+    terms = where(q > 0,p*log(p/where(q > 0,q,1.)),0.)
+    return terms.sum(axis=-1)
+
+def validate(nblocks=40, block_size=5, nsamples=1000, samplers=None,
+             verbose=True):
+    """
+    Validate samplers (all of them by default, the dense sampler being run
+    on each block, see sampler()) on a synthetic swap matrix.
+    Return a dict of the statistics of each sampler: the chi-square
+    statistics of the states after a sweep ('chi2_occupancy') and of the
+    transitions ('chi2_transitions') as returned by chi_square(), the mean
+    and largest Kullback-Liebler divergences of the replica occupancies
+    ('kl_mean', 'kl_max') and the time taken ('time').
+    """
+    if samplers is None:
+        samplers = ['dense','ladder','sparse']
+    U = block_swap_matrix(nblocks,block_size)
+    results = {}
+    for name in samplers:
+        start_time = time.time()
+        sweep,f,neighbors = sampler(U,name,block_size)
+        block_probs,P,T,perms = exact_statistics(U,block_size,f,neighbors)
+        N,C = sample_statistics(sweep,block_probs,perms,nsamples)
+        # Transitions are tested conditional on the observed initial states.
+        counted = N.sum(axis=1)[:,None]
+        starts = C.sum(axis=2)
+        conditional = T/maximum(P,1e-300)[:,:,None]
+        stats = {'chi2_occupancy': chi_square(N,counted*P),
+                 'chi2_transitions':
+                 chi_square(C,starts[:,:,None]*conditional)}
+        kl = kl_divergence(N/maximum(counted,1.),P)
+        stats['kl_mean'] = kl.mean()
+        stats['kl_max'] = kl.max()
+        stats['time'] = time.time() - start_time
+        results[name] = stats
+        if verbose:
+            print ('%-7s occupancy chi2 = %10.1f dof = %6d p = %.3g'
+                   %((name,) + stats['chi2_occupancy']))
+            print ('%-7s transition chi2 = %9.1f dof = %6d p = %.3g'
+                   %(('',) + stats['chi2_transitions']))
+            print ('%-7s KL divergence mean = %.2e max = %.2e (%.1f s)'
+                   %('',stats['kl_mean'],stats['kl_max'],stats['time']))
+    return results
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-b','--blocks',type='int',default=40,
+                      help='number of blocks of replicas [%default]')
+    parser.add_option('-s','--block-size',type='int',default=5,
+                      help='replicas per block, at most 6 [%default]')
+    parser.add_option('-n','--samples',type='int',default=1000,
+                      help='number of sampled sweeps [%default]')
+    parser.add_option('-m','--sampler',action='append',dest='samplers',
+                      help='dense, ladder or sparse (default: all)')
+    parser.add_option('--seed',type='int',default=None,
+                      help='random number seed')
+    options,args = parser.parse_args()
+    if options.block_size > 6:
+        parser.error('blocks of more than 6 replicas are too large to '
+                     'enumerate')
+    if options.seed is not None:
+        random_seed(options.seed)
+    print ('Validating Gibbs sampling with %d replicas in blocks of %d, %d '
+           'samples'%(options.blocks*options.block_size,options.block_size,
+                      options.samples))
+    results = validate(options.blocks,options.block_size,options.samples,
+                       options.samplers)
+    failed = [name for name,stats in results.iteritems()
+              if stats['chi2_occupancy'][2] < 1e-4
+              or stats['chi2_transitions'][2] < 1e-4]
+    if failed:
+        print 'FAILED: %s (p < 1e-4)'%', '.join(failed)
+        sys.exit(1)
+    print 'OK'
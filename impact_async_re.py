@@ -1,5 +1,194 @@
 import os, re, random, math
-from pj_async_re import async_re_job
+from numpy import zeros, ones, fromstring, where
+from pj_async_re import async_re_job, _open
+
+STEP_LINE = " Step number:"
+_number_line = re.compile("(\s+-*\d\.\d+E[\+-]\d+\s*)+")
+
+# Records already read, by reader and file, with the size and modification
+# time of the file when it was read (see _memoized()).
+_impact_cache = {}
+_IMPACT_CACHE_SIZE = 1024
+
+def _memoized(reader, file):
+    """
+Returns reader(file), reading the file again only if its size or 
+modification time changed since it was last read.
+"""
+    try:
+        st = os.stat(file)
+    except OSError:
+        raise IOError('File does not exist: %s' % file)
+    key = (reader.__name__, os.path.abspath(file))
+    stamp = (st.st_size, st.st_mtime)
+    cached = _impact_cache.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    value = reader(file)
+    if len(_impact_cache) >= _IMPACT_CACHE_SIZE:
+        _impact_cache.clear()
+    _impact_cache[key] = (stamp, value)
+    return value
+
+def _read_records(file):
+    """
+Reads all of the data records of an Impact output file in one pass and 
+returns the step numbers, the values of all records as one flat array 
+and the number of values of each record.
+"""
+    steps = []
+    counts = []
+    numbers = []
+    f = _open(file ,"r")
+    try:
+        lines = iter(f)
+        for line in lines:
+            if not line.startswith(STEP_LINE):
+                continue
+            steps.append(int(line.split()[2]))
+            #a record is made of the next 3 lines of numbers
+            count = 0
+            ln = 0
+            while ln < 3:
+                line = next(lines, "")
+                if not line:
+                    raise IOError("Unexpected end of file %s" % file)
+                if _number_line.match(line):
+                    numbers.append(line)
+                    count += len(line.split())
+                    ln += 1
+            counts.append(count)
+    finally:
+        f.close()
+    return steps, fromstring(" ".join(numbers), sep=" "), counts
+
+def _read_table(file):
+    steps, values, counts = _read_records(file)
+    if len(set(counts)) > 1:
+        raise ValueError("Records of different lengths in %s" % file)
+    nf = counts[0] if counts else 0
+    table = zeros((len(steps), nf + 1))
+    table[:,0] = steps
+    table[:,1:] = values.reshape((len(steps), nf))
+    return table
+
+def _read_last_record(file, blocksize=4096):
+    """
+Reads the last data record of an Impact output file, seeking backwards 
+from the end of the file to the last "Step number:" line.
+"""
+    f = _open(file, "rb")
+    try:
+        f.seek(0, 2)
+        pos = f.tell()
+        text = ""
+        start = -1
+        while start < 0 and pos > 0:
+            n = min(blocksize, pos)
+            pos -= n
+            f.seek(pos)
+            text = f.read(n) + text
+            start = text.rfind("\n" + STEP_LINE)
+        if start >= 0:
+            text = text[start+1:]
+        elif not text.startswith(STEP_LINE):
+            raise IOError("No data in file %s" % file)
+    finally:
+        f.close()
+    lines = text.splitlines()
+    record = [int(lines[0].split()[2])]
+    numbers = [line for line in lines[1:] if _number_line.match(line)]
+    if len(numbers) < 3:
+        raise IOError("Unexpected end of file %s" % file)
+    for line in numbers[:3]:
+        record.extend(float(word) for word in line.split())
+    return record
+
+def impact_data(file):
+    """
+Reads all of the Impact simulation data values temperature, energies, etc.
+at each time step and puts into a big table (a list of records, each 
+starting with the step number). Raises IOError if the file is missing or
+ends in the middle of a record.
+"""
+    steps, values, counts = _memoized(_read_records, file)
+    data = []
+    offset = 0
+    for step, count in zip(steps, counts):
+        data.append([step] + values[offset:offset+count].tolist())
+        offset += count
+    return data
+
+def impact_data_array(file):
+    """
+Same as impact_data(), as an array of one row per record (the step number 
+followed by the values), for analysis. Raises ValueError if the records 
+do not all have the same number of values.
+"""
+    return _memoized(_read_table, file)
+
+def impact_last_data(file):
+    """
+Returns the last data record of an Impact output file (see impact_data())
+without reading the rest of the file.
+"""
+    return _memoized(_read_last_record, file)
+
+def impact_last_record(basename, replica, cycle):
+    """
+Returns the last data record of the Impact output of a replica at a cycle.
+"""
+    return impact_last_data("r%s/%s_%d.out" % (replica,basename,cycle))
+
+class impact_template(object):
+    """
+An input file template with @name@ placeholders. The template is read once,
+when the object is created (changes take effect when the job is restarted),
+and compiled into a list alternating text segments and placeholders. The placeholders whose values
+depend only on the state (e.g. @lambda@) are substituted once per state and
+the resulting list cached, so that rendering the input file of a replica
+only fills in the remaining placeholders (e.g. @n@) in a single join.
+Placeholders without a value are left as they are. Raises IOError if the
+template cannot be read.
+"""
+    def __init__(self, filename, names, opener=open):
+        self.filename = filename
+        placeholder = re.compile("@(%s)@" % "|".join(map(re.escape, names)))
+        f = opener(filename, "r")
+        try:
+            text = f.read()
+        finally:
+            f.close()
+        # split() alternates text and the names of the placeholders
+        self._segments = placeholder.split(text)
+        self._states = {}
+
+    def state_segments(self, state, values):
+        """
+Returns the compiled template of a state, with the placeholders in the 
+dictionary 'values' substituted.
+"""
+        segments = self._states.get(state)
+        if segments is None:
+            segments = [self._segments[0]]
+            for i in range(1, len(self._segments), 2):
+                name, text = self._segments[i], self._segments[i+1]
+                if name in values:
+                    segments[-1] += values[name] + text
+                else:
+                    segments.extend([name, text])
+            self._states[state] = segments
+        return segments
+
+    def render(self, state, state_values, values):
+        """
+Returns the text of the template for a state with the placeholders in 
+state_values (the same for every call with this state) and in values 
+substituted.
+"""
+        segments = self.state_segments(state, state_values)
+        return "".join([values.get(s, "@%s@" % s) if i % 2 else s
+                        for i, s in enumerate(segments)])
 
 class pj_impact_job(async_re_job):
 
@@ -61,69 +250,68 @@ Launches Impact sub-job using pilot-job
          compute_unit=self.pilotcompute.submit_compute_unit(compute_unit_description)
          return compute_unit
 
+    def _inpTemplate(self):
+        """
+Returns the compiled template input file BASENAME.inp
+"""
+        if getattr(self, '_template', None) is None:
+            template = "%s.inp" % self.basename
+            try:
+                self._template = impact_template(
+                    template, ["n", "nm1", "lambda", "temperature"],
+                    self._openfile)
+            except (IOError, OSError) as e:
+                self._exit("Unable to read template input file %s: %s" %
+                           (template, e))
+        return self._template
+
     def _getImpactData(self, file):
         """
 Reads all of the Impact simulation data values temperature, energies, etc.
 at each time step and puts into a big table
 """
-        if not os.path.exists(file):
-            msg = 'File does not exist: %s' % file
-            self._exit(msg)
-        step_line = re.compile("^ Step number:")
-        number_line = re.compile("(\s+-*\d\.\d+E[\+-]\d+\s*)+")
-        nsamples = 0
-        data = []
-        f = self._openfile(file ,"r")
-        line = f.readline()
-        while line:
-            # fast forward until we get to the line: 
-            # "Step number: ... "
-            while line and not re.match(step_line, line): 
-                line = f.readline()
-            # read the step number
-            if re.match(step_line, line):
-                words = line.split()
-                step = words[2]
-                #now read up to 3 lines of numbers
-                datablock = [int(step)]
-                ln = 0
-                while ln < 3:
-                    line = f.readline()
-                    if not line:
-                        msg = "Unexpected end of file"
-                        self._exit(msg)
-                    if re.match(number_line, line):
-                        for word in line.split():
-                            datablock.append(float(word))
-                        ln += 1
-                data.append(datablock)
-            line = f.readline()
-        f.close()
-        return data
-        
+        try:
+            return impact_data(file)
+        except IOError as e:
+            self._exit(str(e))
+
+    def _getImpactLastData(self, file):
+        """
+Reads the last data record of an Impact output file
+"""
+        try:
+            return impact_last_data(file)
+        except IOError as e:
+            self._exit(str(e))
+
     def _hasCompleted(self,replica,cycle):
         """
 Returns true if an IMPACT replica has successfully completed a cycle.
 """
         try:
+            #all checks use the same scan of the replica directory
+            files = self._replicaFiles(replica)
             #check existence of rst file
             rstfile = "r%d/%s_%d.rst" % (replica, self.basename,cycle)
-            if not os.path.exists(rstfile):
+            rstname = "%s_%d.rst" % (self.basename,cycle)
+            if not files.exists(rstname):
                 print "Warning: can not find file %s." % rstfile 
                 return False
             #check that rst file is of the correct size
             if cycle > 1:
                 rstfile_p = "r%d/%s_%d.rst" % (replica, self.basename,cycle-1)
-                rstsize = os.path.getsize(rstfile)
-                rstsize_p = os.path.getsize(rstfile_p)
+                rstname_p = "%s_%d.rst" % (self.basename,cycle-1)
+                rstsize = files.getsize(rstname)
+                rstsize_p = files.getsize(rstname_p)
                 if not rstsize == rstsize_p:
                     print "Warning: files %s and %s have different size" % (rstfile,rstfile_p)
                     return False
             #check that we can read data from .out
             output_file = "r%s/%s_%d.out" % (replica,self.basename,cycle)
-            datai = self._getImpactData(output_file)
-            nf = len(datai[0])
-            nr = len(datai)
+            if not files.exists("%s_%d.out" % (self.basename,cycle)):
+                print "Warning: can not find file %s." % output_file
+                return False
+            impact_last_data(output_file)
         except:
             rstfile = "r%d/%s_%d.rst" % (replica, self.basename,cycle)
             rstfile_p = "r%d/%s_%d.rst" % (replica, self.basename,cycle-1)
@@ -132,39 +320,50 @@ Returns true if an IMPACT replica has successfully completed a cycle.
             return False
         return True
 
-    #compute matrix of dimension-less energies: each column is a replica 
-    #and each row is a state
-    #so U[i][j] is the energy of replica j in state i. 
-    #
-    #Note that the matrix is sized to include all of the replicas and states 
-    #but the energies of replicas not 
-    #in waiting state, or those of waiting replicas for states not belonging to 
-    #waiting replicas list are undefined.
-    def _computeSwapMatrix(self, replicas, states):
-        # U will be sparse matrix, but is convenient bc the indices of the
-        # rows and columns will always be the same.
-        U = [[ 0. for j in range(self.nreplicas)] 
-             for i in range(self.nreplicas)]
+    def _completionMarker(self,replica,cycle):
+        """
+The restart file is written at the end of a cycle.
+"""
+        return "%s_%d.rst" % (self.basename,cycle)
 
+    #compute matrix of dimension-less energies of the waiting replicas: each
+    #column is a replica and each row is a state
+    #so U[i][j] is the energy of replica replicas[j] in state states[i]. 
+    #Only the columns of the replicas with elements selected by mask (if
+    #given) are computed, with array operations (see _reduced_energies()).
+    def _computeSwapBlock(self, replicas, states, mask=None):
         n = len(replicas)
+        U = zeros((n,n))
+        if mask is None:
+            mask = ones((n,n),dtype=bool)
+        columns = mask.any(axis=0)
+
+        #collect replica parameters and potentials (in parallel if the
+        #application provides an observable extractor)
+        par = [self._getPar(k) for k in replicas]
+        needed = [i for i in range(n) if columns[i]]
+        if self._observableExtractor() is not None:
+            obs = self._observables([replicas[i] for i in needed])
+        else:
+            obs = [self._getPot(replicas[i],
+                                self.status[replicas[i]]['cycle_current'])
+                   for i in needed]
+        if needed:
+            # energies of the needed replicas in all of the states
+            U[:,needed] = self._reduced_energies(par,obs)
+        return where(mask,U,0.)
 
-        #collect replica parameters and potentials
-        par = []
-        pot = []
-        for k in replicas:
-            v = self._getPot(k,self.status[k]['cycle_current'])
-            l = self._getPar(k)
-            par.append(l)
-            pot.append(v)
-        print pot
-        print par   
-
-        for i in range(n):
-            repl_i = replicas[i]
-            for j in range(n):
-                sid_j = states[j]
-                # energy of replica i in state j
-                U[sid_j][repl_i] = self._reduced_energy(par[j],pot[i])
+    def _reduced_energies(self,par,pot):
+        """
+Returns the matrix of the reduced energies U[j,i] of the replicas with 
+potentials pot[i] in the states with parameters par[j]. Applications 
+override it with array expressions; by default _reduced_energy() is 
+called for each element.
+"""
+        U = zeros((len(par),len(pot)))
+        for i in range(len(pot)):
+            for j in range(len(par)):
+                U[j,i] = self._reduced_energy(par[j],pot[i])
         return U
 
 
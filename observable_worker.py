@@ -0,0 +1,125 @@
+"""
+Extraction of the observables of replicas, locally or in a compute unit.
+
+The observables of the replicas (see async_re_job._observableExtractor())
+are read by a function f(replica, cycle), run either in the processes of the
+observable pool of ASyncRE or, with OBSERVABLE_POOL = 'pilot', by a short
+compute unit running this module on the cores of the pilot, next to the
+replica files, rather than on the host running ASyncRE (typically a cluster
+head node):
+
+python -m observable_worker REQUEST RESULT
+
+REQUEST is a pickle file of the extraction function, of the list of
+(replica, cycle) pairs and of the number of processes to use (see
+write_request()). The function is stored by module and name, with the
+arguments of a functools.partial wrapping it, and imported again by the
+compute unit: an ASyncRE application runs as a script, whose functions
+would otherwise be pickled as members of __main__, which in the compute
+unit is this module. The list of the observables is pickled to the single file
+RESULT, which is written under a temporary name and then renamed, so that
+it only appears once complete (see read_result()).
+"""
+import os
+import sys
+import pickle
+from functools import partial
+from multiprocessing import Pool
+
+__all__ = ['init_worker', 'extract_observables', 'write_request',
+           'read_result', 'run_request']
+
+# Extraction function of the processes of an observable pool, set once when
+# the pool starts (see init_worker()).
+_extractor = None
+
+def init_worker(extractor):
+    """Initializer of the processes of an observable pool."""
+    global _extractor
+    _extractor = extractor
+
+def extract_observables(replicas_and_cycles, extractor=None):
+    """
+    Return the observables of a list of (replica, cycle) pairs, by default
+    with the extraction function of the pool process.
+    """
+    if extractor is None:
+        extractor = _extractor
+    return [extractor(repl,cyc) for repl,cyc in replicas_and_cycles]
+
+def _function_name(function):
+    """
+    Return the module and the name of a module level function. The module
+    of a function of the main script is named after the script.
+    """
+    module = function.__module__
+    if module == '__main__':
+        script = sys.modules['__main__'].__file__
+        module = os.path.splitext(os.path.basename(script))[0]
+    return module,function.__name__
+
+def _import_function(module, name):
+    """Return the function 'name' of a module, importing it if needed."""
+    __import__(module)
+    return getattr(sys.modules[module],name)
+
+def write_request(filename, extractor, replicas_and_cycles, processes=1):
+    """
+    Write the request file of a compute unit. The extraction function must
+    be a module level function, possibly wrapped with functools.partial.
+    """
+    if isinstance(extractor,partial):
+        function = extractor.func
+        args,keywords = extractor.args,extractor.keywords or {}
+    else:
+        function,args,keywords = extractor,(),{}
+    f = open(filename,'wb')
+    pickle.dump({'function': _function_name(function),
+                 'args': args, 'keywords': keywords,
+                 'replicas_and_cycles': list(replicas_and_cycles),
+                 'processes': int(processes)},f,pickle.HIGHEST_PROTOCOL)
+    f.close()
+
+def read_result(filename):
+    """Return the list of observables written by run_request()."""
+    f = open(filename,'rb')
+    try:
+        return pickle.load(f)
+    finally:
+        f.close()
+
+def run_request(request_file, result_file):
+    """
+    Extract the observables listed in a request file, in parallel in chunks
+    of at least two replicas per process, and write them to result_file.
+    """
+    f = open(request_file,'rb')
+    request = pickle.load(f)
+    f.close()
+    extractor = partial(_import_function(*request['function']),
+                        *request['args'],**request['keywords'])
+    todo = request['replicas_and_cycles']
+    nchunks = min(request['processes'],len(todo)/2)
+    if nchunks < 2:
+        results = extract_observables(todo,extractor)
+    else:
+        pool = Pool(processes=nchunks,initializer=init_worker,
+                    initargs=(extractor,))
+        chunks = pool.map(extract_observables,
+                          [todo[n::nchunks] for n in range(nchunks)])
+        pool.close()
+        pool.join()
+        results = [None]*len(todo)
+        for n,chunk in enumerate(chunks):
+            results[n::nchunks] = chunk
+    tmp_file = result_file + '.tmp'
+    f = open(tmp_file,'wb')
+    pickle.dump(results,f,pickle.HIGHEST_PROTOCOL)
+    f.close()
+    os.rename(tmp_file,result_file)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print 'usage: python -m observable_worker REQUEST RESULT'
+        sys.exit(1)
+    run_request(sys.argv[1],sys.argv[2])
@@ -13,11 +13,36 @@ import sys
 import time
 import pickle
 import random
+import hashlib
+from functools import partial
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 from configobj import ConfigObj
+from numpy import arange, bincount, prod, empty, ones, asarray, isnan, \
+    where, ix_, nan
 
 from gibbs_sampling import *
-from pilot import PilotComputeService, ComputeDataService, State
+from state_graph import ladder_neighbors, grid_neighbors, read_neighbors, \
+    local_neighbors, connected_components
+try:
+    from pilot import PilotComputeService, ComputeDataService, State
+except ImportError:
+    # BigJob is only needed to run jobs, not e.g. to benchmark exchanges
+    PilotComputeService = ComputeDataService = State = None
+from completion_watcher import inotify_available, inotify_watcher
+from exchange_stats import exchange_stats
+from state_ledger import state_ledger, ledger_reader
+from observable_worker import init_worker as _init_observable_worker, \
+    extract_observables as _extract_observables, write_request, read_result
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 __version__ = '0.2.1'
 
@@ -52,6 +77,58 @@ def _open(name, mode, max_attempts = 100, wait_time = 1):
         _exit('Too many failures accessing file %s'%name)
     return f
 
+class dir_snapshot(object):
+    """
+    The contents of a directory as seen by a single scan. File names are read 
+    once (with scandir when available) and sizes and modification times are 
+    only looked up, and then cached, for the files actually queried.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._stats = {}
+        try:
+            if _scandir is not None:
+                for entry in _scandir(path):
+                    self._entries[entry.name] = entry
+            else:
+                for name in os.listdir(path):
+                    self._entries[name] = None
+        except OSError:
+            pass
+
+    def _stat(self, name):
+        try:
+            return self._stats[name]
+        except KeyError:
+            pass
+        entry = self._entries[name]
+        if entry is not None:
+            st = entry.stat()
+        else:
+            st = os.stat(os.path.join(self.path,name))
+        self._stats[name] = st
+        return st
+
+    def exists(self, name):
+        """Return True if the directory contains a file with this name."""
+        return name in self._entries
+
+    def getsize(self, name):
+        """Return the size of a file (raises OSError if it does not exist)."""
+        try:
+            return self._stat(name).st_size
+        except KeyError:
+            raise OSError('No such file: %s'%os.path.join(self.path,name))
+
+    def getmtime(self, name):
+        """Return the modification time of a file (raises OSError if it does 
+        not exist)."""
+        try:
+            return self._stat(name).st_mtime
+        except KeyError:
+            raise OSError('No such file: %s'%os.path.join(self.path,name))
+
 class async_re_job(object):
     """
     Class to set up and run asynchronous file-based RE calculations
@@ -59,9 +136,26 @@ class async_re_job(object):
     def __init__(self, command_file, options):
         self.command_file = command_file
         self.cus = {}
+        self._dir_snapshots = {}
+        self.watcher = None
+        self.cu_urls = {}
+        self.pilot_url = None
+        self.reattached = False
+        self.checkpoint = {}
+        self._state_neighbors = None
+        self._energy_cache = None
+        self._energy_cache_key = None
+        self.state_set_version = 0
+        self._observable_cache = {}
+        self._observable_pool = None
+        self._prefetched = {}
+        self._observable_requests = 0
+        self.ledger = None
+        self._inp_pending = set()
         self.jobname = os.path.splitext(os.path.basename(command_file))[0]
         self.keywords = ConfigObj(self.command_file)
         self._checkInput()
+        self.exchange_stats = exchange_stats(self.nreplicas)
         self._printStatus()
 
     def _exit(self, message):
@@ -169,10 +263,40 @@ class async_re_job(object):
         # number of replicas (may be determined by other means)
         self.nreplicas = None
         
-        if self.keywords.get('NEXCHG_ROUNDS') is not None:
+        if self.keywords.get('NEXCHG_ROUNDS') is None:
+            self.nexchg_rounds = 1
+        elif self.keywords.get('NEXCHG_ROUNDS').lower() == 'auto':
+            self.nexchg_rounds = 'auto'
+        else:
             self.nexchg_rounds = int(self.keywords.get('NEXCHG_ROUNDS'))
+        # limits of the adaptive number of exchange rounds
+        if self.keywords.get('NEXCHG_MAX_ROUNDS') is not None:
+            self.nexchg_max_rounds = int(self.keywords.get('NEXCHG_MAX_ROUNDS'))
         else:
-            self.nexchg_rounds = 1
+            self.nexchg_max_rounds = 100
+        if self.keywords.get('NEXCHG_TOLERANCE') is not None:
+            self.nexchg_tolerance = float(self.keywords.get('NEXCHG_TOLERANCE'))
+        else:
+            self.nexchg_tolerance = 0.01
+        # restrict exchanges to neighboring states: 'all' (no restriction), 
+        # 'ladder', 'grid' or the name of a file listing the neighbors
+        if self.keywords.get('EXCHANGE_NEIGHBORS') is not None:
+            self.exchange_neighbors = self.keywords.get('EXCHANGE_NEIGHBORS')
+        else:
+            self.exchange_neighbors = 'all'
+        # prune swaps less likely than this (sparse Gibbs sampling)
+        if self.keywords.get('EXCHANGE_THRESHOLD') is not None:
+            self.exchange_threshold = float(
+                self.keywords.get('EXCHANGE_THRESHOLD'))
+        else:
+            self.exchange_threshold = None
+        if self.keywords.get('EXCHANGE_MAX_CANDIDATES') is not None:
+            self.exchange_max_candidates = int(
+                self.keywords.get('EXCHANGE_MAX_CANDIDATES'))
+            if self.exchange_threshold is None:
+                self.exchange_threshold = 0.
+        else:
+            self.exchange_max_candidates = None
 
         #examine RESOURCE_URL to see if it's remote (file staging)
 #        self.remote = self._check_remote_resource(self.keywords.get('RESOURCE_URL'))
@@ -200,7 +324,48 @@ class async_re_job(object):
             self.verbose = True
         else:
             self.verbose = False
-
+        # event driven completion detection (Linux, local filesystems only)
+        watcher = self.keywords.get('COMPLETION_WATCHER')
+        if watcher is not None and watcher.lower() == 'inotify':
+            self.use_inotify = True
+        else:
+            self.use_inotify = False
+        # reconnect to the pilot and still running replicas when restarting
+        if (self.keywords.get('REATTACH') is not None and
+            self.keywords.get('REATTACH').lower() == 'no'):
+            self.reattach = False
+        else:
+            self.reattach = True
+        # reuse the energies of replicas that wait across several exchanges
+        if (self.keywords.get('ENERGY_CACHE') is not None and
+            self.keywords.get('ENERGY_CACHE').lower() == 'no'):
+            self.energy_cache = False
+        else:
+            self.energy_cache = True
+        # parallel extraction of the observables of replicas (if supported),
+        # serial unless requested since the pools run on the head node
+        if self.keywords.get('OBSERVABLE_POOL') is not None:
+            self.observable_pool = self.keywords.get('OBSERVABLE_POOL').lower()
+            if self.observable_pool not in ['process','thread','pilot','none']:
+                self._exit('OBSERVABLE_POOL must be process, thread, pilot '
+                           'or none')
+        else:
+            self.observable_pool = 'none'
+        if self.keywords.get('OBSERVABLE_WORKERS') is not None:
+            self.observable_workers = int(
+                self.keywords.get('OBSERVABLE_WORKERS'))
+        elif self.observable_pool == 'pilot':
+            self.observable_workers = int(self.keywords.get('SUBJOB_CORES'))
+        else:
+            self.observable_workers = min(4,cpu_count())
+        if self.observable_workers < 2 and self.observable_pool != 'pilot':
+            self.observable_pool = 'none'
+        # time (seconds) to wait for the compute unit of OBSERVABLE_POOL=pilot
+        if self.keywords.get('OBSERVABLE_TIMEOUT') is not None:
+            self.observable_timeout = float(
+                self.keywords.get('OBSERVABLE_TIMEOUT'))
+        else:
+            self.observable_timeout = 60.0
 
     def _linkReplicaFile(self, link_filename, real_filename, repl):
         """
@@ -230,15 +395,34 @@ class async_re_job(object):
         engine input file for replica k. Also creates soft links to the working 
         directory for the accessory files specified in ENGINE_INPUT_EXTFILES.
         """
+        if PilotComputeService is None:
+            self._exit('BigJob (the pilot module) is required to run jobs')
+        # check the state graph before submitting anything
+        self._stateNeighbors()
 	#pilotjob: Initialize PilotJob at given COORDINATION_URL (CU)
         self.pj = PilotComputeService(self.keywords.get('COORDINATION_URL'))
 	#pilotjob: Initialize PilotJob Data service (DU)
         self.cds=ComputeDataService()
-	#pilotjob: Launch the PilotJob at the given COORDINATION_URL
-        self.launch_pilotjob()
 
         if (self.keywords.get('RE_SETUP') is not None and 
             self.keywords.get('RE_SETUP').lower() == 'yes'):
+            restart = False
+        else:
+            restart = True
+            self._read_status()
+            if self.checkpoint.get('exchange_stats') is not None:
+                self.exchange_stats.restore(self.checkpoint['exchange_stats'])
+        # history of the states of the replicas, continued when restarting
+        self.ledger = state_ledger('%s.ledger'%self.basename,new=not restart)
+        # trajectories and round trips, which are not kept in the checkpoint
+        self.exchange_stats.open_log('%s_exchanges.dat'%self.basename,
+                                     new=not restart)
+	#pilotjob: Launch the PilotJob at the given COORDINATION_URL, unless the
+	#pilotjob: one of the interrupted run is still alive
+        if not (restart and self._reattachPilot()):
+            self.launch_pilotjob()
+
+        if not restart:
             # create replicas directories r1, r2, etc.
             for k in range(self.nreplicas):
                 repl_dir = 'r%d'%k
@@ -257,28 +441,101 @@ class async_re_job(object):
                             'cycle_current': 1} for k in range(self.nreplicas)]
             # save status tables
             self._write_status()
-            # create input files no. 1
-            for k in range(self.nreplicas):
-                self._buildInpFile(k)
+            # input files no. 1 are built while the pilot is queued (see
+            # _pilotWaitTasks())
+            self._inp_pending.update(range(self.nreplicas))
             self.updateStatus()
         else:
-            self._read_status()
+            if self.reattached:
+                self._reattachReplicas()
             self.updateStatus(restart=True)
 
 #        if self.remote:
 #            self._setup_remote_workdir()
 
         self.print_status()
-        #at this point all replicas should be in wait state
+        #at this point all replicas should be in wait state, except those 
+        #still running in a reattached pilot
         for k in range(self.nreplicas):
-            if self.status[k]['running_status'] != 'W':
+            if (self.status[k]['running_status'] != 'W' and not
+                (self.status[k]['running_status'] == 'R' and k in self.cus)):
                 _exit('Internal error after restart. Not all jobs are in wait '
                       'state.')
 
+    def _reattachPilot(self):
+        """
+        Reconnect to the pilot recorded in the checkpoint file. Return True if
+        it is still queued or running, otherwise False (a new pilot is needed).
+        """
+        pilot_url = self.checkpoint.get('pilot_url')
+        if not self.reattach or pilot_url is None:
+            return False
+        try:
+            from pilot import PilotCompute
+            pilotcompute = PilotCompute(pilot_url=pilot_url)
+            state = pilotcompute.get_state()
+        except Exception as e:
+            print ('Warning: unable to reconnect to pilot %s (%s), launching a '
+                   'new one'%(pilot_url,e))
+            return False
+        if state not in ['New','Running']:
+            print ('Pilot %s is no longer active (%s), launching a new one'
+                   %(pilot_url,state))
+            return False
+        print 'Reattached to pilot %s (%s)'%(pilot_url,state)
+        self.pilotcompute = pilotcompute
+        self.pilot_url = pilot_url
+        self.reattached = True
+        return True
+
+    def _reattachReplicas(self):
+        """
+        Reconnect to the compute units of the replicas that were running when 
+        the checkpoint was written. Replicas whose compute unit is still alive 
+        are adopted and left in the running state by the restart. Those that
+        exited keep the reconnected compute unit so that their completion can 
+        be checked.
+        """
+        cu_urls = self.checkpoint.get('cu_urls',{})
+        try:
+            from pilot import ComputeUnit
+        except ImportError:
+            print 'Warning: unable to reconnect to compute units'
+            return
+        adopted = 0
+        for k in self.replicas_running:
+            if not cu_urls.has_key(k):
+                continue
+            try:
+                compute_unit = ComputeUnit(cu_url=cu_urls[k])
+                state = compute_unit.get_state()
+            except Exception as e:
+                print ('Warning: unable to reconnect to replica %d (%s)'
+                       %(k,e))
+                continue
+            self.cus[k] = compute_unit
+            self.cu_urls[k] = cu_urls[k]
+            if state not in ['Done','Failed','Canceled']:
+                adopted += 1
+        print 'Reattached to %d running replica(s)'%adopted
+
+    def _pilotUrl(self):
+        """Return the URL of the current pilot (None if unavailable)."""
+        try:
+            return self.pilotcompute.get_url()
+        except Exception:
+            return None
+
+    def _cuUrl(self, compute_unit):
+        """Return the URL of a compute unit (None if unavailable)."""
+        try:
+            return compute_unit.get_url()
+        except Exception:
+            return None
+
     def scheduleJobs(self):
         # wait until bigjob enters executing
-        while self.pilotcompute.get_state() != 'Running':
-            time.sleep(10)
+        self._waitForPilot()
 
         # Gets the wall clock time for a replica to complete a cycle
         # If unspecified it is estimated as 10% of job wall clock time
@@ -299,9 +556,16 @@ class async_re_job(object):
         else:
             cycle_time = float(self.keywords.get('CYCLE_TIME'))
 
+        self._startCompletionWatcher()
+
         start_time = time.time()
         end_time = (start_time + 60*(self.walltime - replica_run_time) - 
                     cycle_time - 10)
+        # input files not built while the pilot was queued
+        self._validateInpFiles()
+        # submit the first wave as soon as the pilot is active
+        self.launchJobs()
+        self.print_status()
         while time.time() < end_time:
             time.sleep(1)
 
@@ -311,7 +575,7 @@ class async_re_job(object):
             self.updateStatus()
             self.print_status()        
 
-            time.sleep(cycle_time)
+            self._waitCompletions(cycle_time)
 
             self.updateStatus()
             self.print_status()        
@@ -322,6 +586,71 @@ class async_re_job(object):
         self.waitJob()
         self.cleanJob()
 
+    def _waitForPilot(self):
+        """
+        Wait until the pilot is running. The tasks returned by 
+        _pilotWaitTasks() are run while the pilot is queued, checking its state
+        after each one. The state is then polled with an interval growing from
+        1 second to PILOT_POLL_TIME seconds (10 by default), so that replicas 
+        are submitted shortly after the pilot starts. Tasks that did not get to
+        run before the pilot started are skipped.
+        """
+        if self.keywords.get('PILOT_POLL_TIME') is None:
+            max_wait = 10.0
+        else:
+            max_wait = float(self.keywords.get('PILOT_POLL_TIME'))
+        tasks = self._pilotWaitTasks()
+        wait = 1.0
+        while True:
+            state = self.pilotcompute.get_state()
+            if state == 'Running':
+                break
+            elif state in ['Done','Failed','Canceled']:
+                _exit('Pilot job terminated (%s) before executing.'%state)
+            if len(tasks) > 0:
+                task = tasks.pop(0)
+                task()
+            else:
+                time.sleep(wait)
+                wait = min(1.5*wait,max_wait)
+
+    def _pilotWaitTasks(self):
+        """
+        Return a list of functions (without arguments) to be called while 
+        waiting for the pilot to start. Applications can extend this list with 
+        work that would otherwise delay the first replicas or exchanges. These
+        tasks must be optional: they are not run if the pilot starts first.
+
+        By default, the input files of the replicas set up by setupJob() are
+        built (or, when restarting, checked and rebuilt if out of date) in 
+        chunks of 16 replicas, so that the pilot is checked in between. Those 
+        left when the pilot starts are built before the first replicas are 
+        launched.
+        """
+        pending = sorted(self._inp_pending)
+        tasks = [partial(self._validateInpFiles,pending[n:n+16])
+                 for n in range(0,len(pending),16)]
+        return tasks + [self._observablePool]
+
+    def _validateInpFiles(self, replicas=None):
+        """
+        Build the input files of the given replicas (by default all of them) 
+        that setupJob() left to build, if they are missing or out of date.
+        """
+        if replicas is None:
+            replicas = sorted(self._inp_pending)
+        rebuilt = 0
+        for k in replicas:
+            if k not in self._inp_pending:
+                continue
+            self._inp_pending.discard(k)
+            if not self._inpFileIsCurrent(k):
+                self._prepareInpFile(k)
+                rebuilt += 1
+        if rebuilt > 0:
+            print 'Built input files of %d waiting replica(s)'%rebuilt
+            self._write_status()
+
     def waitJob(self):
         # cancel all not-running submitted subjobs
 #        for k in range(self.nreplicas):
@@ -332,12 +661,122 @@ class async_re_job(object):
         #update status
 #        self.updateStatus()
 #        self.print_status()
-        #wait until running jobs complete
-        self.cds.wait()
+        #wait until running jobs complete, including the replicas adopted
+        #from a reattached pilot, which the compute data service does not know
+        self._waitReplicas()
+        if not self.reattached:
+            self.cds.wait()
+
+    def _waitReplicas(self):
+        """
+        Wait until the compute units of all running replicas have exited, 
+        polling their state with an interval growing from 1 second to 
+        PILOT_POLL_TIME seconds (10 by default).
+        """
+        if self.keywords.get('PILOT_POLL_TIME') is None:
+            max_wait = 10.0
+        else:
+            max_wait = float(self.keywords.get('PILOT_POLL_TIME'))
+        wait = 1.0
+        pending = [k for k in self.replicas_running if k in self.cus]
+        while len(pending) > 0:
+            running = []
+            for k in pending:
+                try:
+                    state = self.cus[k].get_state()
+                except Exception as e:
+                    print ('Warning: unable to query replica %d (%s)'%(k,e))
+                    continue
+                if state not in ['Done','Failed','Canceled']:
+                    running.append(k)
+            pending = running
+            if len(pending) > 0:
+                time.sleep(wait)
+                wait = min(1.5*wait,max_wait)
 
     def cleanJob(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
         self.cds.cancel()
         self.pj.cancel()
+        if self.reattached:
+            self.pilotcompute.cancel()
+        if self._observable_pool is not None:
+            self._observable_pool.close()
+            self._observable_pool.join()
+            self._observable_pool = None
+        if self.ledger is not None:
+            self.ledger.close()
+        self.exchange_stats.save('%s_exchange_stats.npz'%self.basename)
+
+    def _completionMarker(self, replica, cycle):
+        """
+        Return the name of the file, in the directory of the replica, whose 
+        appearance marks the end of the given cycle or None if there is no such
+        file. MD engine modules should override this to enable event driven 
+        completion detection (see COMPLETION_WATCHER).
+        """
+        return None
+
+    def _startCompletionWatcher(self):
+        """Start watching for completion markers if requested."""
+        if not self.use_inotify or self.watcher is not None:
+            return
+        if not inotify_available():
+            print ('Warning: inotify is not available, replicas will be '
+                   'polled every CYCLE_TIME seconds')
+            return
+        if str(self.keywords.get('RESOURCE_URL')).split(':')[0] != 'fork':
+            print ('Warning: inotify only detects files written by this host, '
+                   'replicas running elsewhere will be polled every '
+                   'CYCLE_TIME seconds')
+        self.watcher = inotify_watcher()
+        for k in self.replicas_running:
+            self._watchCompletion(k,self.status[k]['cycle_current'])
+
+    def _watchCompletion(self, replica, cycle):
+        """
+        Register the completion marker of a newly launched replica. It stays
+        registered until the replica is found done (see 
+        _updateStatus_replica()) or relaunched.
+        """
+        if self.watcher is None:
+            return
+        marker = self._completionMarker(replica,cycle)
+        if marker is not None:
+            self.watcher.watch(replica,'r%d'%replica,marker)
+
+    def _waitCompletions(self, timeout):
+        """
+        Wait for up to 'timeout' seconds. When a completion watcher is active, 
+        return as soon as a running replica has written its completion marker 
+        and its compute unit has exited. The compute unit may be reported as 
+        done shortly after the marker is written, so it is polled with a short
+        backoff; if it is still running after a few seconds the marker was
+        written before the end of the cycle, and the replica waits for the 
+        next one.
+        """
+        if self.watcher is None:
+            time.sleep(timeout)
+            return
+        end_time = time.time() + timeout
+        signaled = {}
+        wait = 0.05
+        remaining = timeout
+        while remaining > 0:
+            now = time.time()
+            for k in self.watcher.get(remaining if not signaled else 
+                                      min(wait,remaining)):
+                signaled.setdefault(k,now)
+            for k,first in signaled.items():
+                if (self.status[k]['running_status'] != 'R' or 
+                    self._isDone(k,self.status[k]['cycle_current'])):
+                    return
+                if time.time() - first > 5.0:
+                    del signaled[k]
+            wait = min(2*wait,1.0) if signaled else 0.05
+            remaining = end_time - time.time()
         
     def launch_pilotjob(self):
 	#pilotjob: PilotJob description
@@ -357,25 +796,54 @@ class async_re_job(object):
         self.pj.create_pilot(pilot_compute_description=pcd)
         self.cds.add_pilot_compute_service(self.pj)
         self.pilotcompute = self.pj.list_pilots()[0]
+        self.pilot_url = self._pilotUrl()
         
     def _write_status(self):
         """
         Pickle the current state of the RE job and write to in BASENAME.stat. 
+        The status table is followed by a dict of additional checkpoint data 
+        (see _checkpointData()). The file is written under a temporary name 
+        and then renamed, so that an interrupted write does not destroy the
+        previous checkpoint.
         """
+        if self.ledger is not None:
+            self.ledger.flush()
         status_file = '%s.stat'%self.basename
-        f = _open(status_file,'w')
+        f = _open(status_file + '.tmp','wb')
         pickle.dump(self.status,f)
+        pickle.dump(self._checkpointData(),f,pickle.HIGHEST_PROTOCOL)
         f.close()
+        os.rename(status_file + '.tmp',status_file)
 
     def _read_status(self):
         """
         Unpickle and load the current state of the RE job from BASENAME.stat.
+        Additional checkpoint data, if present, is loaded in self.checkpoint.
         """
         status_file = '%s.stat'%self.basename
-        f = _open(status_file,'r')
+        f = _open(status_file,'rb')
         self.status = pickle.load(f)
+        try:
+            self.checkpoint = pickle.load(f)
+        except EOFError:
+            # written by an older version
+            self.checkpoint = {}
         f.close()
 
+    def _checkpointData(self):
+        """
+        Return a dict of data saved with the status table: the URLs of the 
+        pilot and of the compute units of the running replicas, used to
+        reattach to them after a restart, and the counters of the exchange 
+        statistics (see exchange_stats.state()).
+        """
+        cu_urls = {}
+        for k in self.replicas_running:
+            if self.cu_urls.get(k) is not None:
+                cu_urls[k] = self.cu_urls[k]
+        return {'pilot_url': self.pilot_url, 'cu_urls': cu_urls,
+                'exchange_stats': self.exchange_stats.state()}
+
     def print_status(self):
         """
         Writes to BASENAME_stat.txt a text version of the status of the RE job. 
@@ -398,6 +866,8 @@ class async_re_job(object):
 
     def updateStatus(self, restart = False):
         """Scan the replicas and update their states."""
+        # Replica directories are scanned at most once per poll.
+        self._dir_snapshots = {}
         for k in range(self.nreplicas):
             self._updateStatus_replica(k,restart)
         self._write_status()
@@ -410,26 +880,413 @@ class async_re_job(object):
         """
         this_cycle = self.status[replica]['cycle_current']
         if restart:
+            if (self.status[replica]['running_status'] == 'R' and 
+                self.cus.has_key(replica) and 
+                not self._isDone(replica,this_cycle)):
+                # still running in the reattached pilot
+                return
             if self.status[replica]['running_status'] == 'R':
                 if self._hasCompleted(replica,this_cycle):
                     self.status[replica]['cycle_current'] += 1
+                    self._prefetchObservables(replica,this_cycle)
                 else:
                     print ('_updateStatus_replica(): Warning: restarting '
                            'replica %d (cycle %d)'%(replica,this_cycle))
-            self._buildInpFile(replica)
+            # Input files that are missing or out of date with respect to the
+            # checkpointed state, cycle, and templates are regenerated while
+            # the pilot is queued (see _pilotWaitTasks()).
+            self._inp_pending.add(replica)
             self.status[replica]['running_status'] = 'W'
         else:
             if self.status[replica]['running_status'] == 'R':
                 if self._isDone(replica,this_cycle):
+                    if self.watcher is not None:
+                        self.watcher.discard(replica)
                     self.status[replica]['running_status'] = 'S'
                     if self._hasCompleted(replica,this_cycle):
                         self.status[replica]['cycle_current'] += 1
+                        self._prefetchObservables(replica,this_cycle)
                     else:
                         print ('_updateStatus_replica(): Warning: restarting '
                                'replica %d (cycle %d)'%(replica,this_cycle))
-                    self._buildInpFile(replica)
+                    self._prepareInpFile(replica)
                     self.status[replica]['running_status'] = 'W'
 
+    def _stateLabel(self, stateid):
+        """
+        Optional. Return a string describing a state (e.g. its parameters), 
+        written after the state id in the state history files of the 
+        replicas (see writeStateHistories()), or None.
+        """
+        return None
+
+    def writeStateHistories(self):
+        """
+        Write the history of the states of each replica, one line per cycle
+        with the cycle, the state id and the label of the state (see 
+        _stateLabel()), to r<k>/state.history, from the state ledger.
+        """
+        if self.ledger is not None:
+            self.ledger.flush()
+        labels = [self._stateLabel(sid) for sid in range(self.nreplicas)]
+        if None in labels:
+            labels = None
+        reader = ledger_reader('%s.ledger'%self.basename)
+        reader.write_state_histories('r%d/state.history',labels)
+
+    def _inpTemplateFiles(self):
+        """
+        Return a list of the template files from which the replica input files
+        are generated. Input files generated from a different version of these 
+        templates are considered out of date. Applications should override this
+        with the files actually read by _buildInpFile().
+        """
+        return []
+
+    def _inpFiles(self, replica):
+        """
+        Return a list of the files (relative to the working directory) that 
+        _buildInpFile() creates for the specified replica at its current cycle.
+        Applications should override this so that missing inputs are detected.
+        """
+        return []
+
+    def _templateHash(self):
+        """Return an md5 digest of the input templates (computed once)."""
+        try:
+            return self._template_hash
+        except AttributeError:
+            md5 = hashlib.md5()
+            for name in self._inpTemplateFiles():
+                md5.update(name)
+                if os.path.exists(name):
+                    f = _open(name,'rb')
+                    md5.update(f.read())
+                    f.close()
+            self._template_hash = md5.hexdigest()
+            return self._template_hash
+
+    def _inpFingerprint(self, replica):
+        """
+        Return a cheap fingerprint of the inputs of the specified replica: 
+        (state id, cycle, template hash).
+        """
+        return (self.status[replica]['stateid_current'],
+                self.status[replica]['cycle_current'],
+                self._templateHash())
+
+    def _inpFileIsCurrent(self, replica):
+        """
+        Return True if the input files of the specified replica were built for
+        its current state and cycle from the current templates and all of them
+        still exist.
+        """
+        fingerprint = self.status[replica].get('inp_fingerprint')
+        if fingerprint != self._inpFingerprint(replica):
+            return False
+        for name in self._inpFiles(replica):
+            if not os.path.exists(name):
+                return False
+        return True
+
+    def _prepareInpFile(self, replica):
+        """
+        Build the input files of the specified replica and record their 
+        fingerprint in the status table.
+        """
+        self._buildInpFile(replica)
+        self.status[replica]['inp_fingerprint'] = self._inpFingerprint(replica)
+
+    def _replicaFiles(self, replica):
+        """
+        Return a dir_snapshot of the directory of the specified replica. The 
+        directory is scanned on first use and the result is shared by all 
+        completion checks until the next call to updateStatus().
+        """
+        try:
+            return self._dir_snapshots[replica]
+        except KeyError:
+            snapshot = dir_snapshot('r%d'%replica)
+            self._dir_snapshots[replica] = snapshot
+            return snapshot
+
+    def _computeSwapBlock(self, replicas, states, mask=None):
+        """
+        Return the k x k array U of the reduced energies of the k replicas 
+        being exchanged in the states they hold: U[a,i] is the energy of 
+        replica replicas[i] in state states[a]. That is, 'states' and 
+        'replicas' map the rows and columns of U to state and replica ids.
+
+        Application classes should override this. For compatibility, the 
+        default extracts the block from the full matrix returned by 
+        _computeSwapMatrix(), indexed as U[stateid][replica].
+
+        When exchanges are restricted to neighboring states a k x k boolean
+        'mask' is also passed: only the elements where it is True are used 
+        and the others can be left at any value.
+        """
+        return swap_block(self._computeSwapMatrix(replicas,states),replicas,
+                          states)
+
+    def _cachedSwapBlock(self, replicas, states, mask=None):
+        """
+        Return _computeSwapBlock(replicas,states,mask), computing only the 
+        elements not already in the energy cache. The energies of a replica 
+        cannot change until it runs again, so they are kept, for all states,
+        from one exchange to the next and are only recomputed after the
+        replica is launched or the states change (see
+        _invalidateEnergyCache()). Elements outside of the mask are zero.
+        """
+        if not self.energy_cache:
+            if mask is None:
+                return self._computeSwapBlock(replicas,states)
+            return self._computeSwapBlock(replicas,states,mask)
+        if self._energy_cache is None:
+            # _energy_cache[sid,repl] is the energy of replica repl in state 
+            # sid at the (cycle, state set version) in _energy_cache_key[repl]
+            self._energy_cache = empty((self.nreplicas,self.nreplicas))
+            self._energy_cache.fill(nan)
+            self._energy_cache_key = -ones((self.nreplicas,2),dtype=int)
+        cache = self._energy_cache
+        replicas = asarray(replicas,dtype=int)
+        key = asarray([(self.status[k]['cycle_current'],self.state_set_version)
+                       for k in replicas],dtype=int)
+        stale = (self._energy_cache_key[replicas] != key).any(axis=1)
+        cache[:,replicas[stale]] = nan
+        self._energy_cache_key[replicas[stale]] = key[stale]
+
+        block = cache[ix_(states,replicas)]
+        needed = isnan(block)
+        if mask is not None:
+            needed &= mask
+        if needed.any():
+            if mask is None and needed.all():
+                U = self._computeSwapBlock(list(replicas),states)
+            else:
+                U = self._computeSwapBlock(list(replicas),states,needed)
+            block[needed] = asarray(U,dtype=float)[needed]
+        cache[ix_(states,replicas)] = block
+        if self.verbose:
+            print ('%d of %d swap matrix columns taken from the energy cache'
+                   %((~needed.any(axis=0)).sum(),len(replicas)))
+        return where(isnan(block),0.,block)
+
+    def _invalidateEnergyCache(self, replicas=None):
+        """
+        Forget the cached energies of the given replicas or, by default, of 
+        all replicas. Applications must call this without arguments whenever 
+        the definition of the states changes.
+        """
+        if replicas is None:
+            self.state_set_version += 1
+            return
+        for k in replicas:
+            self._observable_cache.pop(k,None)
+            self._prefetched.pop(k,None)
+        if self._energy_cache_key is not None:
+            self._energy_cache_key[replicas] = -1
+
+    def _observableExtractor(self):
+        """
+        Optional. Return a function f(replica, cycle) returning the observables
+        of a replica at the end of a cycle (e.g. its potential energies or 
+        restraint coordinates), from which the application computes its swap
+        matrix, or None if the application does not support it. The function 
+        must be a module level function, possibly wrapped with 
+        functools.partial, and only read files. With OBSERVABLE_POOL = 'pilot'
+        its module is imported by name in the compute unit (that of the 
+        script if it is defined there, see observable_worker.py).
+        """
+        return None
+
+    def _observablePool(self):
+        """
+        Return the pool of processes (or threads) extracting observables, or 
+        None if extraction is serial. The pool is started on first use and 
+        kept for the whole job; its processes receive the extraction function 
+        once, when they start.
+        """
+        if (self._observable_pool is None 
+            and self.observable_pool in ['process','thread']
+            and self._observableExtractor() is not None):
+            if self.observable_pool == 'thread':
+                self._observable_pool = ThreadPool(self.observable_workers)
+            else:
+                self._observable_pool = Pool(
+                    processes=self.observable_workers,
+                    initializer=_init_observable_worker,
+                    initargs=(self._observableExtractor(),))
+        return self._observable_pool
+
+    def _extractionArgs(self, replicas_and_cycles):
+        """Return the arguments of _extract_observables() in the pool."""
+        if self.observable_pool == 'thread':
+            return (replicas_and_cycles,self._observableExtractor())
+        return (replicas_and_cycles,)
+
+    def _prefetchObservables(self, replica, cycle):
+        """
+        Start extracting, in the observable pool, the observables of a replica
+        that just completed a cycle, so that they are already in memory when
+        the replica takes part in an exchange.
+        """
+        pool = self._observablePool()
+        if pool is None:
+            return
+        self._prefetched[replica] = (cycle,pool.apply_async(
+            _extract_observables,self._extractionArgs([(replica,cycle)])))
+
+    def _observables(self, replicas):
+        """
+        Return the list of the observables (see _observableExtractor()) of 
+        the given replicas at their current cycle. Observables are cached 
+        until a replica is launched again. Those not prefetched when the 
+        replica completed its cycle are extracted in parallel, in chunks of at
+        least two replicas per worker, or in a compute unit on the pilot with
+        OBSERVABLE_POOL = 'pilot'.
+        """
+        todo = []
+        for k in replicas:
+            cycle = self.status[k]['cycle_current']
+            if self._observable_cache.get(k,(None,))[0] == cycle:
+                continue
+            prefetched = self._prefetched.pop(k,None)
+            if prefetched is not None and prefetched[0] == cycle:
+                try:
+                    self._observable_cache[k] = (cycle,prefetched[1].get()[0])
+                    continue
+                except Exception:
+                    pass # extract it again below
+            todo.append((k,cycle))
+        nchunks = min(self.observable_workers,len(todo)/2)
+        pool = self._observablePool()
+        if self.observable_pool == 'pilot' and len(todo) > 0:
+            results = self._extractOnPilot(todo)
+            if results is None:
+                results = _extract_observables(todo,
+                                               self._observableExtractor())
+        elif pool is None or nchunks < 2:
+            results = _extract_observables(todo,self._observableExtractor())
+        else:
+            args = [self._extractionArgs(todo[n::nchunks]) 
+                    for n in range(nchunks)]
+            chunks = [pool.apply_async(_extract_observables,a) for a in args]
+            results = [None]*len(todo)
+            for n,chunk in enumerate(chunks):
+                results[n::nchunks] = chunk.get()
+        for (k,cycle),obs in zip(todo,results):
+            self._observable_cache[k] = (cycle,obs)
+        return [self._observable_cache[k][1] for k in replicas]
+
+    def _observableEnvironment(self):
+        """
+        Return the environment (a list of 'NAME=value' strings) of the compute
+        unit extracting observables on the pilot. It must be able to import
+        the modules of the extraction function.
+        """
+        path = [os.path.abspath(p) for p in sys.path if p != '']
+        return (['PYTHONPATH=%s'%os.pathsep.join([os.getcwd()] + path)] + 
+                self.engine_environment)
+
+    def _extractOnPilot(self, replicas_and_cycles):
+        """
+        Return the observables of a list of (replica, cycle) pairs extracted
+        by a compute unit running observable_worker on the pilot, which 
+        writes them to a single result file. Return None, so that they are 
+        extracted locally, if the compute unit fails or does not complete 
+        within OBSERVABLE_TIMEOUT seconds.
+        """
+        self._observable_requests += 1
+        name = '%s_observables_%d'%(self.basename,self._observable_requests)
+        request = os.path.join(os.getcwd(),name + '.req')
+        result = os.path.join(os.getcwd(),name + '.pkl')
+        write_request(request,self._observableExtractor(),replicas_and_cycles,
+                      self.observable_workers)
+        cpt_unit_desc = {
+            'executable': sys.executable,
+            'environment': self._observableEnvironment(),
+            'arguments': ['-m','observable_worker',request,result],
+            'output': '%s_observables.log'%self.basename,
+            'error': '%s_observables.err'%self.basename,
+            'working_directory': os.getcwd(),
+            'number_of_processes': self.observable_workers,
+            'spmd_variation': 'single',
+            }
+        start_time = time.time()
+        compute_unit = self.pilotcompute.submit_compute_unit(cpt_unit_desc)
+        wait = 0.1
+        state = compute_unit.get_state()
+        while state not in ['Done','Failed','Canceled']:
+            if time.time() - start_time > self.observable_timeout:
+                compute_unit.cancel()
+                break
+            time.sleep(wait)
+            wait = min(2*wait,2.0)
+            state = compute_unit.get_state()
+        results = None
+        try:
+            results = read_result(result)
+            os.remove(result)
+        except Exception:
+            pass
+        os.remove(request)
+        if results is None or len(results) != len(replicas_and_cycles):
+            print ('Warning: extraction of observables on the pilot failed '
+                   '(%s), reading them locally'%state)
+            return None
+        if self.verbose:
+            print ('Observables of %d replicas extracted on the pilot in %f s'
+                   %(len(results),time.time() - start_time))
+        return results
+
+    def _stateGridShape(self):
+        """
+        Return the shape of the grid of states used with EXCHANGE_NEIGHBORS = 
+        grid (state ids in C order, the last dimension varying fastest). The 
+        default is a one dimensional ladder, application classes with multi-
+        dimensional states should override this. The STATE_GRID_SHAPE keyword
+        takes precedence.
+        """
+        return (self.nreplicas,)
+
+    def _stateGridPeriodic(self):
+        """Return, for each dimension of the state grid, if it wraps around."""
+        return [False]*len(self._stateGridShape())
+
+    def _stateNeighbors(self):
+        """
+        Return the state graph that exchanges are restricted to (see 
+        state_graph.py), or None if any two waiting replicas can exchange.
+        """
+        mode = self.exchange_neighbors
+        if mode.lower() == 'all':
+            return None
+        if self._state_neighbors is not None:
+            return self._state_neighbors
+        if mode.lower() == 'ladder':
+            neighbors = ladder_neighbors(self.nreplicas)
+        elif mode.lower() == 'grid':
+            if self.keywords.get('STATE_GRID_SHAPE') is not None:
+                shape = [int(n) for n in 
+                         self.keywords.get('STATE_GRID_SHAPE').split(',')]
+                periodic = None
+            else:
+                shape = self._stateGridShape()
+                periodic = self._stateGridPeriodic()
+            if prod(shape) != self.nreplicas:
+                self._exit('The state grid %s does not match the number of '
+                           'states (%d)'%('x'.join(str(n) for n in shape),
+                                          self.nreplicas))
+            neighbors = grid_neighbors(shape,periodic)
+        else:
+            try:
+                neighbors = read_neighbors(mode,self.nreplicas)
+            except (IOError,ValueError) as e:
+                self._exit('Problem reading EXCHANGE_NEIGHBORS = %s: %s'
+                           %(mode,e))
+        self._state_neighbors = neighbors
+        return neighbors
+
     def _isDone(self,replica,cycle):
         """
         Generic function to check if a replica completed a cycle. 
@@ -493,6 +1350,9 @@ class async_re_job(object):
         available_slots = (int(self.keywords.get('TOTAL_CORES')) / 
                            int(self.keywords.get('SUBJOB_CORES')))
         max_njobs_submitted = int((1.+subjobs_buffer_size)*available_slots)
+        # keep a slot free for the compute units extracting observables
+        if self.observable_pool == 'pilot':
+            max_njobs_submitted = max(1,max_njobs_submitted - 1)
         nlaunch = self.waiting - max(2,self.nreplicas - max_njobs_submitted)
         nlaunch = max(0,nlaunch)
         if self.verbose:
@@ -519,7 +1379,13 @@ class async_re_job(object):
                            %(k,self.status[k]['cycle_current']))
                 self.cus[k] = (
                     self._launchReplica(k,self.status[k]['cycle_current']))
+                self.cu_urls[k] = self._cuUrl(self.cus[k])
                 self.status[k]['running_status'] = 'R'
+                self._invalidateEnergyCache([k])
+                self._watchCompletion(k,self.status[k]['cycle_current'])
+                if self.ledger is not None:
+                    self.ledger.append(k,self.status[k]['cycle_current'],
+                                       self.status[k]['stateid_current'])
 
     def doExchanges(self):
         """Perform exchanges among waiting replicas using Gibbs sampling."""
@@ -539,57 +1405,107 @@ class async_re_job(object):
         for k in replicas_to_exchange:
             self.status[k]['cycle_current'] -= 1
             self.status[k]['running_status'] = 'E'
-        # Matrix of replica energies in each state.
-        # The computeSwapMatrix() function is defined by application 
-        # classes (Amber/US, Impact/BEDAM, etc.)
+        # Matrix of replica energies in each state, restricted to the waiting
+        # replicas: U[a,i] is the energy of replica replicas_to_exchange[i] in
+        # state states_to_exchange[a]. The _computeSwapBlock() function is 
+        # defined by application classes (Amber/US, Impact/BEDAM, etc.)
         matrix_start_time = time.time()
-        swap_matrix = self._computeSwapMatrix(replicas_to_exchange,
-                                              states_to_exchange)
+        neighbors = self._stateNeighbors()
+        mask = None
+        if neighbors is None:
+            U = self._cachedSwapBlock(replicas_to_exchange,states_to_exchange)
+        else:
+            # Replicas only move between waiting states connected through 
+            # other waiting states, so U is needed only within the connected
+            # components of the state graph restricted to those states (and 
+            # not at all for replicas without waiting neighbors).
+            neighbors = local_neighbors(neighbors,states_to_exchange)
+            comp = connected_components(neighbors)
+            mask = comp[:,None] == comp[None,:]
+            mask[:,bincount(comp)[comp] < 2] = False
+            U = self._cachedSwapBlock(replicas_to_exchange,states_to_exchange,
+                                      mask)
         matrix_time = time.time() - matrix_start_time
 
         sampling_start_time = time.time()
-        # Perform an exchange for each of the n replicas, m times
-        if self.nexchg_rounds >= 0:
-            mreps = self.nexchg_rounds
-        else:
-            mreps = nreplicas_to_exchange**(-self.nexchg_rounds)
-        accept_count = 0
-        for reps in range(mreps):
-            for repl_i in replicas_to_exchange:
-                sid_i = self.status[repl_i]['stateid_current'] 
-                curr_states = [self.status[repl_j]['stateid_current'] 
-                               for repl_j in replicas_to_exchange]
-                repl_j = pairwise_independence_sampling(repl_i,sid_i,
-                                                        replicas_to_exchange,
-                                                        curr_states,
-                                                        swap_matrix)
-                if repl_j != repl_i:
-                    sid_i = self.status[repl_i]['stateid_current'] 
-                    sid_j = self.status[repl_j]['stateid_current']
-                    self.status[repl_i]['stateid_current'] = sid_j
-                    self.status[repl_j]['stateid_current'] = sid_i
-                    accept_count += 1
-
-        # Uncomment to debug Gibbs sampling: 
+        # perm[i] is the row of U of the state held by replica i.
+        perm = arange(nreplicas_to_exchange)
+        if self.exchange_threshold is not None:
+            # Only exchange candidate pairs of states (sparse sampling). The
+            # elements of U outside of the mask were not computed.
+            candidates = swap_candidates(U,self.exchange_threshold,
+                                         self.exchange_max_candidates,
+                                         neighbors,mask)
+            pruned = pruned_swap_probability(U,perm,candidates,neighbors)
+            print ('%.1f swap candidates per state, pruned swap probability '
+                   '%.3g'%(sum([len(c) for c in candidates])
+                           /float(nreplicas_to_exchange),pruned))
+            neighbors = candidates
+        # Perform an exchange for each of the n replicas, m times or, in 
+        # adaptive mode, until the permutation stops changing
+        if self.nexchg_rounds == 'auto':
+            info = {}
+            accept_count = adaptive_sweeps(
+                lambda n: pairwise_independence_sweeps(U,perm,n,neighbors),
+                perm,self.nexchg_max_rounds,self.nexchg_tolerance,info=info)
+            mreps = info['nsweeps']
+            print ('%d exchange rounds, %.0f%% of the replicas moved, %.0f%% '
+                   'exchanged in the last round'%(mreps,100*info['moved'],
+                                                  100*info['change_rate']))
+        else:
+            if self.nexchg_rounds >= 0:
+                mreps = self.nexchg_rounds
+            else:
+                mreps = nreplicas_to_exchange**(-self.nexchg_rounds)
+            accept_count = pairwise_independence_sweeps(U,perm,mreps,neighbors)
+
+        # Uncomment to debug Gibbs sampling (instead of the line above): 
         # Actual and observed populations of state permutations should match.
+        # This enumerates all permutations, beyond ~8 replicas see instead
+        # gibbs_validation.py.
         # 
-        #     self._debug_collect_state_populations(replicas_to_exchange)
+        # accept_count = 0
+        # for reps in range(mreps):
+        #     accept_count += pairwise_independence_sweeps(U,perm,1,neighbors)
+        #     self._debug_collect_state_populations(replicas_to_exchange,
+        #         [states_to_exchange[a] for a in perm])
         # self._debug_validate_state_populations(replicas_to_exchange,
-        #                                        states_to_exchange,swap_matrix)
+        #                                        states_to_exchange,U)
+        new_states = [states_to_exchange[a] for a in perm]
+        for repl_i,sid in zip(replicas_to_exchange,new_states):
+            self.status[repl_i]['stateid_current'] = sid
         sampling_time = time.time() - sampling_start_time
         for k in replicas_to_exchange:
-            # Place replicas back into "W" (wait) state.
+            # Place replicas back into "W" (wait) state. Replicas that changed
+            # state need new input files for the next cycle.
             self.status[k]['cycle_current'] += 1
+            if not self._inpFileIsCurrent(k):
+                self._prepareInpFile(k)
             self.status[k]['running_status'] = 'W'
+        self.exchange_stats.update(
+            replicas_to_exchange,states_to_exchange,new_states,
+            [self.status[k]['cycle_current'] for k in replicas_to_exchange])
+        if self.ledger is not None:
+            # the partner of a replica held its new state before the exchange
+            for i,a in enumerate(perm):
+                if a != i:
+                    k = replicas_to_exchange[i]
+                    self.ledger.append(k,self.status[k]['cycle_current'],
+                                       new_states[i],replicas_to_exchange[a])
 
         total_time = time.time() - exchange_start_time
 
         print '------------------------------------------'
         print 'Swap matrix computation time: %10.2f s'%matrix_time
         print 'Gibbs sampling time         : %10.2f s'%sampling_time
+        if mreps > 0:
+            print ('  per exchange round        : %10.2f ms'
+                   %(1000*sampling_time/mreps))
         print '------------------------------------------'
         print 'Total exchange time         : %10.2f s'%total_time
         print '%d exchanges accepted'%accept_count
+        if self.verbose:
+            print self.exchange_stats.summary()
 
 
 #     def _check_remote_resource(self, resource_url):
@@ -631,7 +1547,7 @@ class async_re_job(object):
 
 # """
       
-    def _debug_collect_state_populations(self, replicas):
+    def _debug_collect_state_populations(self, replicas, curr_states=None):
         """
         Calculate the empirically observed distribution of state permutations. 
         Permutations not observed will NOT be counted and will need to be
@@ -641,7 +1557,8 @@ class async_re_job(object):
             self.nperm
         except (NameError,AttributeError):
             self.nperm = {}
-        curr_states = [self.status[i]['stateid_current'] for i in replicas]
+        if curr_states is None:
+            curr_states = [self.status[i]['stateid_current'] for i in replicas]
         curr_perm = str(zip(replicas,curr_states))
         if self.nperm.has_key(curr_perm):
             self.nperm[curr_perm] += 1
@@ -656,6 +1573,9 @@ class async_re_job(object):
         """
         empirical = sample_to_state_perm_distribution(self.nperm,replicas,
                                                       states)
+        # state_perm_distribution() expects U[stateid][replica]
+        U = dict([(sid,dict(zip(replicas,U[a]))) 
+                  for a,sid in enumerate(states)])
         exact = state_perm_distribution(replicas,states,U)
         print '%8s %-9s %-9s %-s'%('','empirical','exact','state permutation')
         print '-'*80
@@ -0,0 +1,146 @@
+"""
+State adjacency graphs for neighborhood-restricted replica exchange.
+
+A state graph is a list 'neighbors' such that neighbors[a] is a sorted
+integer array of the states adjacent to state a (never including a itself).
+Adjacency is always symmetric. Graphs can be built for a one dimensional
+ladder of states, for a multi-dimensional grid of states (numbered in C
+order, the last dimension varying fastest) or read from a file.
+"""
+from numpy import arange, asarray, unique, zeros, empty, concatenate, \
+    ravel_multi_index, unravel_index, allclose, diff, prod
+
+__all__ = ['ladder_neighbors', 'grid_neighbors', 'read_neighbors',
+           'grid_shape', 'grid_spacing', 'local_neighbors',
+           'connected_components']
+
+def _from_sets(sets):
+    return [asarray(sorted(s),dtype=int) for s in sets]
+
+def ladder_neighbors(nstates, periodic=False):
+    """Return the state graph of a one dimensional ladder of states."""
+    return grid_neighbors((nstates,),(periodic,))
+
+def grid_neighbors(shape, periodic=None):
+    """
+    Return the state graph of a grid of states with the given shape, in
+    which states differing by one step along a single dimension are
+    adjacent. 'periodic' is an optional list of flags, one per dimension,
+    that connects the first and last states along that dimension.
+    """
+    shape = tuple(int(n) for n in shape)
+    if periodic is None:
+        periodic = [False]*len(shape)
+    nstates = int(prod(shape))
+    index = asarray(unravel_index(arange(nstates),shape))
+    sets = [set() for a in xrange(nstates)]
+    for d,(n,wrap) in enumerate(zip(shape,periodic)):
+        if n < 2:
+            continue
+        for step in (-1,1):
+            other = index.copy()
+            other[d] += step
+            if wrap:
+                other[d] %= n
+                valid = arange(nstates)
+            else:
+                valid = ((other[d] >= 0) & (other[d] < n)).nonzero()[0]
+            b = ravel_multi_index(tuple(other[:,valid]),shape)
+            for a,b_a in zip(valid,b):
+                if a != b_a:
+                    sets[a].add(b_a)
+    return _from_sets(sets)
+
+def read_neighbors(filename, nstates):
+    """
+    Read a custom state graph. Each (non-empty) line of the file lists a
+    state followed by any number of the states adjacent to it; everything
+    after a '#' is ignored. Adjacency is made symmetric and states not
+    mentioned are left without neighbors.
+    """
+    sets = [set() for a in xrange(nstates)]
+    for n,line in enumerate(open(filename,'r')):
+        tokens = line.split('#')[0].split()
+        if len(tokens) == 0:
+            continue
+        try:
+            ids = [int(t) for t in tokens]
+        except ValueError:
+            raise ValueError('Bad state graph line %d of %s'%(n+1,filename))
+        for b in ids:
+            if b < 0 or b >= nstates:
+                raise ValueError('Unknown state %d on line %d of %s'
+                                 %(b,n+1,filename))
+        a = ids[0]
+        for b in ids[1:]:
+            if b != a:
+                sets[a].add(b)
+                sets[b].add(a)
+    return _from_sets(sets)
+
+def grid_shape(points):
+    """
+    Return the shape of the grid formed by a list of n-dimensional points
+    (e.g. umbrella positions), or None if the points are not a complete
+    grid in C order (the last coordinate varying fastest).
+    """
+    points = asarray(points,dtype=float)
+    if points.ndim != 2:
+        return None
+    axes = [unique(points[:,d]) for d in xrange(points.shape[1])]
+    shape = tuple(len(x) for x in axes)
+    if int(prod(shape)) != len(points):
+        return None
+    index = asarray(unravel_index(arange(len(points)),shape))
+    expected = concatenate([x[i][:,None] for x,i in zip(axes,index)],axis=1)
+    if not allclose(points,expected):
+        return None
+    return shape
+
+def grid_spacing(points, shape):
+    """
+    Return, for each dimension of a grid of points, the grid spacing, or
+    None if the points along that dimension are not evenly spaced.
+    """
+    points = asarray(points,dtype=float)
+    spacing = []
+    for d,n in enumerate(shape):
+        x = unique(points[:,d])
+        if n < 2 or not allclose(diff(x),x[1]-x[0]):
+            spacing.append(None)
+        else:
+            spacing.append(x[1] - x[0])
+    return spacing
+
+def local_neighbors(neighbors, states):
+    """
+    Return the state graph induced on a subset of the states, numbered by
+    their position in 'states'.
+    """
+    local = empty(len(neighbors),dtype=int)
+    local.fill(-1)
+    local[asarray(states,dtype=int)] = arange(len(states))
+    sets = []
+    for sid in states:
+        b = local[neighbors[sid]]
+        sets.append(b[b >= 0])
+    return [asarray(sorted(b),dtype=int) for b in sets]
+
+def connected_components(neighbors):
+    """Return an array of connected component labels of a state graph."""
+    nstates = len(neighbors)
+    labels = zeros(nstates,dtype=int)
+    labels.fill(-1)
+    ncomp = 0
+    for a in xrange(nstates):
+        if labels[a] >= 0:
+            continue
+        labels[a] = ncomp
+        stack = [a]
+        while stack:
+            for b in neighbors[stack.pop()]:
+                if labels[b] < 0:
+                    labels[b] = ncomp
+                    stack.append(b)
+        ncomp += 1
+    return labels
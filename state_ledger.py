@@ -0,0 +1,163 @@
+"""
+Binary ledger of the states of the replicas of an asynchronous RE job.
+
+A state_ledger is a single append-only file (BASENAME.ledger) with one
+fixed size record each time a replica is launched and one for each replica
+that changes state in an exchange:
+
+time     seconds since the epoch (float64)
+replica  replica index (int32)
+cycle    cycle that the replica runs next (int32)
+state    state id of the replica in that cycle (int32)
+partner  for an exchange, the replica that held the state before it;
+         -1 for a launch (int32)
+
+Records are buffered in memory and written in batches, so that the ledger
+costs one write per batch instead of one file per replica and cycle on the
+shared filesystem. A ledger_reader loads the whole ledger as a numpy record
+array, indexed by replica, and can derive from it the traditional
+r<k>/state.history text files (one "cycle state" line per launch), also
+from the command line:
+
+python state_ledger.py BASENAME.ledger [--history]
+"""
+import os
+import sys
+import time
+import struct
+
+from numpy import dtype, frombuffer, zeros, unique, searchsorted, \
+    column_stack
+
+__all__ = ['RECORD_DTYPE', 'state_ledger', 'ledger_reader']
+
+MAGIC = 'ASRELDG1'
+_RECORD = struct.Struct('<diiii')
+RECORD_DTYPE = dtype([('time','<f8'),('replica','<i4'),('cycle','<i4'),
+                      ('state','<i4'),('partner','<i4')])
+
+class state_ledger(object):
+    """
+    Append records to the ledger 'filename', flushing them every
+    'buffer_size' records. An existing ledger is continued (a partial last
+    record, left by an interrupted write, is dropped) unless 'new' is True.
+    """
+    def __init__(self, filename, buffer_size=4096, new=False):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self._buffer = []
+        if new or not os.path.exists(filename):
+            f = open(filename,'wb')
+            f.write(MAGIC)
+            f.close()
+            return
+        f = open(filename,'r+b')
+        try:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a state ledger'%filename)
+            f.seek(0,2)
+            extra = (f.tell() - len(MAGIC))%_RECORD.size
+            if extra > 0:
+                f.truncate(f.tell() - extra)
+        finally:
+            f.close()
+
+    def append(self, replica, cycle, state, partner=-1, time_stamp=None):
+        """Add a record (see the module docstring) to the ledger."""
+        if time_stamp is None:
+            time_stamp = time.time()
+        self._buffer.append(_RECORD.pack(time_stamp,replica,cycle,state,
+                                         partner))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered records to the ledger."""
+        if not self._buffer:
+            return
+        f = open(self.filename,'ab')
+        f.write(''.join(self._buffer))
+        f.close()
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+
+class ledger_reader(object):
+    """
+    The records of a ledger (see the module docstring) as a numpy record
+    array with fields time, replica, cycle, state and partner, in the order
+    in which they were written.
+    """
+    def __init__(self, filename):
+        f = open(filename,'rb')
+        try:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a state ledger'%filename)
+            data = f.read()
+        finally:
+            f.close()
+        nrecords = len(data)/RECORD_DTYPE.itemsize
+        self.records = frombuffer(data[:nrecords*RECORD_DTYPE.itemsize],
+                                  dtype=RECORD_DTYPE)
+        # records sorted by replica (stably, so still in order of writing)
+        self._order = self.records['replica'].argsort(kind='mergesort')
+        self.replicas = unique(self.records['replica'])
+
+    def __len__(self):
+        return len(self.records)
+
+    def replica_records(self, replica):
+        """Return the records of a replica."""
+        replicas = self.records['replica'][self._order]
+        start = searchsorted(replicas,replica,'left')
+        end = searchsorted(replicas,replica,'right')
+        return self.records[self._order[start:end]]
+
+    def launches(self):
+        """Return the records of the launches of the replicas."""
+        return self.records[self.records['partner'] < 0]
+
+    def exchanges(self):
+        """Return the records of the state changes in exchanges."""
+        return self.records[self.records['partner'] >= 0]
+
+    def state_history(self, replica):
+        """Return the (cycle, state) rows of the launches of a replica."""
+        records = self.replica_records(replica)
+        records = records[records['partner'] < 0]
+        if len(records) == 0:
+            return zeros((0,2),dtype=int)
+        return column_stack((records['cycle'],records['state']))
+
+    def write_state_histories(self, filename_format='r%d/state.history',
+                              labels=None):
+        """
+        Write the state history of each replica as lines of cycle and state,
+        followed by labels[state] (e.g. its parameters) if labels are given.
+        """
+        for replica in self.replicas:
+            f = open(filename_format%replica,'w')
+            for cycle,state in self.state_history(replica):
+                if labels is None:
+                    f.write('%d %d\n'%(cycle,state))
+                else:
+                    f.write('%d %d %s\n'%(cycle,state,labels[state]))
+            f.close()
+
+    def summary(self):
+        """Return a one line summary of the ledger."""
+        return ('%d records: %d launches and %d state changes of %d replicas'
+                %(len(self),len(self.launches()),len(self.exchanges()),
+                  len(self.replicas)))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[2:] not in ([],['--history']):
+        print 'usage: state_ledger.py BASENAME.ledger [--history]'
+        sys.exit(1)
+    reader = ledger_reader(sys.argv[1])
+    print reader.summary()
+    if sys.argv[2:] == ['--history']:
+        reader.write_state_histories()
+        print 'Written r<k>/state.history for %d replicas'%len(reader.replicas)
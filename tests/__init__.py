@@ -0,0 +1,4 @@
+"""
+Unit tests of the ASyncRE modules that run without BigJob. Run them from the
+top directory with python -m unittest discover -s tests -t .
+"""
@@ -0,0 +1,83 @@
+"""
+The checkpoint of exchange_stats: it holds only fixed-size counters, the
+trajectories and round trips going to the exchange log, which is truncated
+back to the checkpoint on restart and continues the trajectories of a
+checkpoint written before the log existed.
+"""
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from numpy import array_equal
+from numpy.random import seed as random_seed, permutation, randint
+
+from exchange_stats import exchange_stats
+
+class ExchangeLogTest(unittest.TestCase):
+
+    def setUp(self):
+        random_seed(0)
+        self.dir = tempfile.mkdtemp()
+        self.nstates = 8
+        self.state = range(self.nstates)
+        self.cycle = [1]*self.nstates
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def exchange(self, *stats):
+        n = self.nstates
+        replicas = sorted(permutation(n)[:randint(2,n+1)])
+        before = [self.state[k] for k in replicas]
+        after = list(permutation(before))
+        for k,a in zip(replicas,after):
+            self.state[k] = a
+            self.cycle[k] += 1
+        cycles = [self.cycle[k] for k in replicas]
+        for s in stats:
+            s.update(replicas,before,after,cycles)
+
+    def test_restart(self):
+        """The checkpoint is small and the log is continued from it"""
+        filename = os.path.join(self.dir,'job_exchanges.dat')
+        memory = exchange_stats(self.nstates)
+        logged = exchange_stats(self.nstates,buffer_size=7)
+        logged.open_log(filename,new=True)
+        for t in xrange(200):
+            self.exchange(memory,logged)
+        checkpoint = pickle.dumps(logged.state())
+        expected = pickle.dumps(memory.state())
+        self.assertTrue(len(checkpoint) < len(expected)/10)
+        # exchanges after the checkpoint are lost by the restart
+        for t in xrange(100):
+            self.exchange(logged)
+        restarted = exchange_stats(self.nstates)
+        restarted.restore(pickle.loads(checkpoint))
+        restarted.open_log(filename)
+        self.assertTrue(array_equal(restarted.trajectories,
+                                    memory.trajectories))
+        self.assertTrue(array_equal(restarted.round_trips,
+                                    memory.round_trips))
+        self.assertEqual(restarted.summary(),memory.summary())
+        for t in xrange(100):
+            self.exchange(memory,restarted)
+        self.assertTrue(array_equal(restarted.trajectories,
+                                    memory.trajectories))
+
+    def test_old_checkpoint(self):
+        """Trajectories of a checkpoint without a log are moved to the log"""
+        memory = exchange_stats(self.nstates)
+        for t in xrange(50):
+            self.exchange(memory)
+        restarted = exchange_stats(self.nstates)
+        restarted.restore(pickle.loads(pickle.dumps(memory.state())))
+        restarted.open_log(os.path.join(self.dir,'job_exchanges.dat'))
+        self.assertTrue(array_equal(restarted.trajectories,
+                                    memory.trajectories))
+        self.assertEqual(restarted.state()['nrecords'],
+                         len(memory.trajectories) + len(memory.round_trips))
+
+if __name__ == '__main__':
+    unittest.main()
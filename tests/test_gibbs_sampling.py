@@ -0,0 +1,53 @@
+"""
+swap_candidates() and pruned_swap_probability() on swap matrices where
+doExchanges() computed only some of the elements (EXCHANGE_NEIGHBORS).
+"""
+import unittest
+
+from numpy import arange, where
+from numpy.random import seed as random_seed
+
+from gibbs_sampling import swap_candidates, pruned_swap_probability
+from gibbs_validation import block_swap_matrix
+
+class SwapCandidatesTest(unittest.TestCase):
+
+    def setUp(self):
+        random_seed(1)
+        # Blocks of 4 states far apart, with energies well above zero: only
+        # the elements of U within a block are computed by doExchanges(), the
+        # others are left to zero.
+        self.nstates = 12
+        self.U = 100. + block_swap_matrix(3,4)
+        block = arange(self.nstates)/4
+        self.mask = block[:,None] == block[None,:]
+        self.neighbors = [(block == block[a]).nonzero()[0]
+                          for a in range(self.nstates)]
+        self.Uzero = where(self.mask,self.U,0.)
+
+    def test_masked_block(self):
+        """The uncomputed elements of U are not taken as energies"""
+        expected = swap_candidates(self.U,0.3,None,self.neighbors)
+        candidates = swap_candidates(self.Uzero,0.3,None,self.neighbors,
+                                     self.mask)
+        for a in range(self.nstates):
+            self.assertEqual(list(candidates[a]),list(expected[a]))
+        perm = arange(self.nstates)
+        self.assertEqual(pruned_swap_probability(self.Uzero,perm,candidates,
+                                                 self.neighbors),
+                         pruned_swap_probability(self.U,perm,expected,
+                                                 self.neighbors))
+
+    def test_masked_out_replica(self):
+        """States whose elements were not computed have no candidates"""
+        mask = self.mask.copy()
+        mask[:,:4] = False
+        U = where(mask,self.U,0.)
+        candidates = swap_candidates(U,0.3,2,None,mask)
+        for a in range(4):
+            self.assertEqual(len(candidates[a]),0)
+        for a in range(4,self.nstates):
+            self.assertTrue(all(c >= 4 for c in candidates[a]))
+
+if __name__ == '__main__':
+    unittest.main()
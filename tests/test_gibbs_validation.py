@@ -0,0 +1,39 @@
+"""
+The statistics of gibbs_validation.py: p-values of chi-square statistics
+with few or many degrees of freedom, the pooling of rarely expected
+categories, and a small end-to-end validation of the three samplers.
+"""
+import unittest
+
+from numpy.random import seed as random_seed
+
+from gibbs_validation import chi_square, chi_square_pvalue, validate
+
+class ChiSquareTest(unittest.TestCase):
+
+    def test_pvalue(self):
+        """p-values of tabulated 95% quantiles, for few and many dof"""
+        for chi2,dof in [(3.841,1),(5.991,2),(18.307,10),(1074.679,1000)]:
+            self.assertAlmostEqual(chi_square_pvalue(chi2,dof),0.05,3)
+        self.assertEqual(chi_square_pvalue(0.,3),1.)
+
+    def test_pooling(self):
+        """A pool expected too rarely is merged, keeping the totals equal"""
+        # first row: the pool of 3 + 1 joins the category expected 10 times
+        chi2,dof,p = chi_square([[22,6,5,1],[12,8,5,5]],
+                                [[20,10,3,1],[10,10,5,5]])
+        self.assertAlmostEqual(chi2,4./20 + 4./14 + 4./10 + 4./10)
+        self.assertEqual(dof,1 + 3)
+
+class ValidateTest(unittest.TestCase):
+
+    def test_samplers(self):
+        """The samplers pass on a small synthetic swap matrix"""
+        random_seed(2)
+        results = validate(10,4,200,verbose=False)
+        for name,stats in results.iteritems():
+            self.assertTrue(stats['chi2_occupancy'][2] > 1e-4,name)
+            self.assertTrue(stats['chi2_transitions'][2] > 1e-4,name)
+
+if __name__ == '__main__':
+    unittest.main()
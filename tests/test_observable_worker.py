@@ -0,0 +1,65 @@
+"""
+OBSERVABLE_POOL = pilot: a request written by an application script, whose
+extraction function belongs to __main__, is run by python -m
+observable_worker in a separate process and directory.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from observable_worker import read_result
+
+# An application script, with its extraction function, writing a request
+# when run as the main script (as ASyncRE applications are).
+SCRIPT = '''
+import sys
+from functools import partial
+from observable_worker import write_request
+
+def extractor(offset, replica, cycle, scale=1):
+    return offset + scale*replica*cycle
+
+if __name__ == '__main__':
+    write_request(sys.argv[1],partial(extractor,10,scale=2),
+                  [(1,2),(3,4),(5,6),(7,8)],int(sys.argv[2]))
+'''
+
+class ComputeUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        f = open(os.path.join(self.dir,'app_async_re.py'),'w')
+        f.write(SCRIPT)
+        f.close()
+        # as passed by async_re_job._observableEnvironment()
+        top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.pathsep.join([self.dir,top])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def round_trip(self, processes):
+        request = os.path.join(self.dir,'job_observables_1.req')
+        result = os.path.join(self.dir,'job_observables_1.pkl')
+        subprocess.check_call([sys.executable,
+                               os.path.join(self.dir,'app_async_re.py'),
+                               request,str(processes)],env=self.env)
+        # the compute unit runs in another directory
+        subprocess.check_call([sys.executable,'-m','observable_worker',
+                               request,result],env=self.env,cwd='/')
+        return read_result(result)
+
+    def test_main_script_extractor(self):
+        """An extractor of the main script is imported by the worker"""
+        self.assertEqual(self.round_trip(1),[14,34,70,122])
+
+    def test_processes(self):
+        """The worker extracts in parallel processes"""
+        self.assertEqual(self.round_trip(2),[14,34,70,122])
+
+if __name__ == '__main__':
+    unittest.main()